@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+
+# Atomic writes of outputs, caches and build state
+#   Every file or directory is written to a uniquely named temporary path next to it and renamed into place, so readers never
+#   see a partially written one. tempfile creates temporary files readable by their owner only and the rename keeps that mode,
+#   so the temporary paths are given the permissions of the process umask first, as a file opened for writing at path would get.
+
+# Umask of the process, read once on import since reading it means setting it, which is not safe once worker threads create files
+process_umask = os.umask(0o022)
+os.umask(process_umask)
+
+
+# Return the path of a new, empty temporary file next to path with the permissions of a new file at path
+def create_temp_file(path):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    os.close(fd)
+    os.chmod(tmp_path, 0o666 & ~process_umask)
+    return tmp_path
+
+
+# Write to path through a temporary file in the same directory, renaming it into place once write(tmp_path) returns
+def write_file_atomic(path, write):
+    tmp_path = create_temp_file(path)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+# Atomically write text to path
+def write_text_atomic(path, text):
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+    write_file_atomic(path, write)
+
+
+# Write to the directory at path through a temporary directory next to it, swapping it into place once write(tmp_dir) returns
+def write_dir_atomic(path, write):
+    parent_dir = os.path.dirname(os.path.abspath(path))
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir, suffix='.tmp')
+    try:
+        os.chmod(tmp_dir, 0o777 & ~process_umask)
+        write(tmp_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir)
+        raise
+    # A non-empty directory can not be replaced by a rename, move the previous output aside first
+    old_dir = None
+    if os.path.exists(path):
+        old_dir = tempfile.mkdtemp(dir=parent_dir, suffix='.old')
+        os.replace(path, os.path.join(old_dir, 'previous'))
+    os.replace(tmp_dir, path)
+    if old_dir is not None:
+        shutil.rmtree(old_dir)
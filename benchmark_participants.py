@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import make_participants_tsv as mpt
+from column_encoding import encode_columns
+from make_fixtures import fixture_sources, make_fixtures
+from manifest_index import manifest_subject_sessions
+from run_report import peak_rss_bytes, reset_peak_rss
+from source_registry import load_sources, merge_sources, plan_source_reads
+
+# Benchmark of make_participants_tsv.py on the synthetic fixtures of make_fixtures.py
+#   Each scale runs in its own process so the peak RSS of one scale does not carry over to the next.
+#   Every pipeline stage reports its wall time and the peak RSS reached while it ran.
+
+default_scales = [10000, 50000, 200000]
+
+
+# Run a pipeline stage, appending its wall time and peak RSS to stages, and return its result
+def run_stage(stages, name, function, *args):
+    reset_peak_rss()
+    start = time.perf_counter()
+    result = function(*args)
+    stages.append({'stage': name, 'seconds': round(time.perf_counter() - start, 3), 'peak_rss_mb': round(peak_rss_bytes() / 1024 ** 2, 1)})
+    return result
+
+
+# Run every stage of make_participants_tsv.py on the fixtures in fixtures_dir, returning the stage measurements
+#   The stages mirror build_participants so each one is measured on its own
+def benchmark_pipeline(fixtures_dir, cache_dir=None):
+    sources = fixture_sources(fixtures_dir)
+    registry = sources['registry']
+    stages = []
+
+    qc_subjects = run_stage(stages, 'load fastqc01', mpt.load_qc_subjects, sources['fastqc01_path'], cache_dir)
+    c3165_subject_sessions = run_stage(stages, 'load 3165 manifest', manifest_subject_sessions, sources['c3165_manifest_path'], mpt.c3165_associated_file_pattern, cache_dir)
+    matched_groups_df = run_stage(stages, 'load matched groups', mpt.load_matched_groups, sources['original_participants_path'])
+    source_dfs = {}
+    for path, read in plan_source_reads(registry).items():
+        source_dfs.update(run_stage(stages, f'load {os.path.basename(path)}', load_sources, {path: read}, qc_subjects, cache_dir))
+
+    participants_df = run_stage(stages, 'merge sources', merge_sources, qc_subjects, registry, source_dfs, mpt.merge_dtypes)
+    participants_df = run_stage(stages, 'format BIDS keys', mpt.format_bids_keys, participants_df)
+    participants_df = run_stage(stages, 'add DCAN columns', mpt.add_dcan_columns, participants_df, c3165_subject_sessions, matched_groups_df)
+    participants_df = run_stage(stages, 'encode columns', encode_columns, participants_df, mpt.column_specs, mpt.derived_columns)
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        output_path = os.path.join(output_dir, 'participants.tsv')
+        run_stage(stages, 'sort and write', lambda: participants_df[mpt.reordered_columns].sort_values(by='participant_id').to_csv(output_path, sep='\t', index=False))
+
+    return {'rows': len(participants_df), 'stages': stages, 'total_seconds': round(sum(stage['seconds'] for stage in stages), 3)}
+
+
+# Print the stage measurements of every scale as a table
+def print_report(results):
+    for result in results:
+        print(f"\n{result['subjects']} subjects, {result['rows']} participants.tsv rows, {result['total_seconds']} s total")
+        print(f"{'stage':<36}{'seconds':>10}{'peak RSS MB':>14}")
+        for stage in result['stages']:
+            print(f"{stage['stage']:<36}{stage['seconds']:>10}{stage['peak_rss_mb']:>14}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark make_participants_tsv.py on synthetic NDA-format fixtures')
+    parser.add_argument('--fixtures-dir', default=os.path.join(tempfile.gettempdir(), 'abcc-participants-fixtures'),
+                        help='Directory the fixtures of each scale are generated into and reused from')
+    parser.add_argument('--scales', type=int, nargs='+', default=default_scales, help=f'Numbers of subjects to benchmark (default: {default_scales})')
+    parser.add_argument('--master-columns', type=int, default=200, help='Number of extra columns in the master data file (default: 200)')
+    parser.add_argument('--cache-dir', help='Read the sources through this Parquet cache instead of parsing the text files')
+    parser.add_argument('--json', help='Also write the measurements to this json file')
+    parser.add_argument('--run-one', metavar='FIXTURES_DIR', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Child process: benchmark one scale and print its measurements as json
+    if args.run_one:
+        print(json.dumps(benchmark_pipeline(args.run_one, args.cache_dir)))
+        sys.exit()
+
+    results = []
+    for subjects in args.scales:
+        fixtures_dir = os.path.join(args.fixtures_dir, f'subjects_{subjects}_columns_{args.master_columns}')
+        if not os.path.isdir(fixtures_dir):
+            print(f'Generating fixtures for {subjects} subjects in {fixtures_dir}')
+            make_fixtures(fixtures_dir, subjects, args.master_columns)
+        command = [sys.executable, __file__, '--run-one', fixtures_dir] + (['--cache-dir', args.cache_dir] if args.cache_dir else [])
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        results.append({'subjects': subjects, **json.loads(output.strip().splitlines()[-1])})
+
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+# Declarative typing pass run on participants_df once every source has been merged
+#   column_specs: hashmap of participants.tsv column name to a spec hashmap with the optional keys
+#     remap: hashmap of source value to participants.tsv value, every non-NaN value must be mapped
+#     fill: sentinel value the NaNs are filled with (e.g. 888)
+#     dtype: type the column is cast to after filling (e.g. 'int')
+#   derived_columns: hashmap of new participants.tsv column name to a spec hashmap with the keys
+#     derive: name of the function in derive_functions that computes the column
+#     columns: participants.tsv columns the new column is derived from
+#     any further keys are passed to the derive function
+
+
+# Row-wise max of columns where the low_codes (e.g. 999 Don't Know and 777 Refused) rank below every valid answer
+#   low_codes: hashmap of code to the rank it takes in the comparison, which must be below every valid answer
+#   Follows Python's max(), so a NaN in the first column is kept while a NaN in a later column is ignored
+def coded_max(participants_df, columns, low_codes):
+    # Compare as float64 so the missing values of nullable integer columns are NaN rather than pd.NA
+    ranked = participants_df[columns].astype('float64').replace(low_codes)
+    result = ranked[columns[0]]
+    for col in columns[1:]:
+        result = result.where(~(ranked[col] > result), ranked[col])
+    return result.replace({rank: code for code, rank in low_codes.items()})
+
+
+# Functions available to derived_columns specs
+derive_functions = {
+    'coded_max': coded_max
+}
+
+
+# Apply the derived_columns and column_specs to participants_df, returning the encoded dataframe
+#   Every step is a vectorized operation over whole columns, with all fills and casts done in a single call each
+def encode_columns(participants_df, column_specs, derived_columns):
+    participants_df = participants_df.copy()
+
+    for name, spec in derived_columns.items():
+        options = {key: value for key, value in spec.items() if key not in ('derive', 'columns')}
+        participants_df[name] = derive_functions[spec['derive']](participants_df, spec['columns'], **options)
+
+    for name, spec in column_specs.items():
+        if 'remap' not in spec:
+            continue
+        column = participants_df[name]
+        remapped = column.map(spec['remap'])
+        unmapped = column[column.notna() & remapped.isna()].unique()
+        if len(unmapped):
+            raise ValueError(f'{name} has values without a mapping: {sorted(map(str, unmapped))}')
+        participants_df[name] = remapped
+
+    participants_df = participants_df.fillna({name: spec['fill'] for name, spec in column_specs.items() if 'fill' in spec})
+    participants_df = participants_df.astype({name: spec['dtype'] for name, spec in column_specs.items() if 'dtype' in spec})
+
+    return participants_df
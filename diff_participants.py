@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import numpy as np
+import pandas as pd
+from incremental import key_columns
+
+# Release to release diff of participants.tsv
+#   Both files are read as text and aligned on (participant_id, session_id). Every shared column is hashed once per file,
+#   so the aligned rows are compared as matrices of 64-bit hashes instead of cell by cell. Reports the rows added, removed
+#   and changed, the number of changed values per column and the shift in each column's rate of the 888 sentinel.
+#     python diff_participants.py participants_v1.0.0/participants.tsv participants_v1.0.3/participants.tsv --json diff.json
+
+# Values written for the 888 sentinel of missing values, by integer and by float columns
+sentinel_values = ['888', '888.0']
+
+
+# Load a participants.tsv as the text it holds
+def load_release(path):
+    return pd.read_csv(path, sep='\t', dtype=str, keep_default_na=False)
+
+
+# Return release_df indexed by its keys with repeated keys dropped (keeping the first row), and the number of rows dropped
+def key_rows(release_df):
+    duplicated = release_df.duplicated(key_columns)
+    return release_df[~duplicated].set_index(key_columns), int(duplicated.sum())
+
+
+# Return the matrix of the 64-bit hashes of the values of columns in release_df, one matrix column per column
+def column_hashes(release_df, columns):
+    if not columns:
+        return np.empty((len(release_df), 0), dtype='uint64')
+    return np.column_stack([pd.util.hash_array(release_df[col].to_numpy(dtype=object)) for col in columns])
+
+
+# Return the fraction of the values of each column of release_df that are the 888 sentinel
+def sentinel_rates(release_df, columns):
+    return {col: float(release_df[col].isin(sentinel_values).mean()) if len(release_df) else 0.0 for col in columns}
+
+
+# Diff the old and new releases, returning a hashmap of the added, removed and changed rows, the added and removed columns,
+#   the changed value count of every shared column over the shared rows and the 888 sentinel rate of every shared column over
+#   all rows of both releases
+def diff_releases(old_df, new_df):
+    old_keyed, old_duplicates = key_rows(old_df)
+    new_keyed, new_duplicates = key_rows(new_df)
+    shared_columns = [col for col in new_keyed.columns if col in old_keyed.columns]
+
+    added_keys = new_keyed.index.difference(old_keyed.index, sort=False)
+    removed_keys = old_keyed.index.difference(new_keyed.index, sort=False)
+    shared_keys = new_keyed.index[new_keyed.index.isin(old_keyed.index)]
+    old_shared = old_keyed.loc[shared_keys, shared_columns]
+    new_shared = new_keyed.loc[shared_keys, shared_columns]
+    differs = column_hashes(old_shared, shared_columns) != column_hashes(new_shared, shared_columns)
+
+    # Changed rows with the columns that differ, from the coordinates of the differing hashes
+    changed_rows, changed_columns = np.nonzero(differs)
+    changed_df = pd.DataFrame({'row': changed_rows, 'column': np.array(shared_columns, dtype=object)[changed_columns]})
+    changed = []
+    for row, columns in changed_df.groupby('row', sort=True)['column']:
+        participant_id, session_id = shared_keys[row]
+        changed.append({'participant_id': participant_id, 'session_id': session_id, 'columns': list(columns)})
+
+    # The 888 rates are taken over every row of each release, so rows added or removed with the sentinel shift them too
+    old_rates = sentinel_rates(old_keyed, shared_columns)
+    new_rates = sentinel_rates(new_keyed, shared_columns)
+    return {
+        'rows': {'old': len(old_df), 'new': len(new_df), 'shared': len(shared_keys)},
+        'duplicate_keys': {'old': old_duplicates, 'new': new_duplicates},
+        'added_columns': [col for col in new_keyed.columns if col not in old_keyed.columns],
+        'removed_columns': [col for col in old_keyed.columns if col not in new_keyed.columns],
+        'added': [dict(zip(key_columns, key)) for key in added_keys],
+        'removed': [dict(zip(key_columns, key)) for key in removed_keys],
+        'changed': changed,
+        'column_changes': {col: int(count) for col, count in zip(shared_columns, differs.sum(axis=0))},
+        'sentinel_rates': {col: {'old': old_rates[col], 'new': new_rates[col], 'shift': new_rates[col] - old_rates[col]} for col in shared_columns}
+    }
+
+
+# Return one row per changed value of the shared rows, with the old and new value
+def changed_values_long(old_df, new_df, diff):
+    old_keyed = key_rows(old_df)[0]
+    new_keyed = key_rows(new_df)[0]
+    changes = pd.DataFrame([(row['participant_id'], row['session_id'], col) for row in diff['changed'] for col in row['columns']],
+                           columns=[*key_columns, 'column'])
+    keys = pd.MultiIndex.from_frame(changes[key_columns])
+    old_values = old_keyed.reindex(keys)
+    new_values = new_keyed.reindex(keys)
+    column_positions = [old_keyed.columns.get_loc(col) for col in changes['column']]
+    changes['old'] = old_values.to_numpy()[np.arange(len(changes)), column_positions] if len(changes) else []
+    column_positions = [new_keyed.columns.get_loc(col) for col in changes['column']]
+    changes['new'] = new_values.to_numpy()[np.arange(len(changes)), column_positions] if len(changes) else []
+    return changes
+
+
+# Print a summary of the diff: row and column counts, then every column with changed values or a shifted 888 rate
+def print_diff(diff, old_path, new_path):
+    print(f"{old_path}: {diff['rows']['old']} rows, {new_path}: {diff['rows']['new']} rows, {diff['rows']['shared']} shared")
+    print(f"{len(diff['added'])} rows added, {len(diff['removed'])} removed and {len(diff['changed'])} changed")
+    for release in ('old', 'new'):
+        if diff['duplicate_keys'][release]:
+            print(f"{diff['duplicate_keys'][release]} repeated keys in the {release} release, only their first rows were compared")
+    if diff['added_columns'] or diff['removed_columns']:
+        print(f"Columns added: {diff['added_columns']}, removed: {diff['removed_columns']}")
+
+    columns = [col for col in diff['column_changes'] if diff['column_changes'][col] or diff['sentinel_rates'][col]['shift']]
+    if columns:
+        print(f"\n{'column':<52}{'changed':>9}{'888 old':>10}{'888 new':>10}{'shift':>10}")
+        for col in columns:
+            rates = diff['sentinel_rates'][col]
+            print(f"{col:<52}{diff['column_changes'][col]:>9}{rates['old']:>10.2%}{rates['new']:>10.2%}{rates['shift']:>+10.2%}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Diff two participants.tsv releases aligned on participant_id and session_id')
+    parser.add_argument('old', help='Previous participants.tsv release')
+    parser.add_argument('new', help='New participants.tsv release')
+    parser.add_argument('--json', help='Write the full diff, including every added, removed and changed row, to this json file')
+    parser.add_argument('--changes-tsv', help='Write every changed value with its old and new value to this tsv')
+    args = parser.parse_args()
+
+    old_df = load_release(args.old)
+    new_df = load_release(args.new)
+    diff = diff_releases(old_df, new_df)
+    print_diff(diff, args.old, args.new)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'old': args.old, 'new': args.new, **diff}, f, indent=2)
+    if args.changes_tsv:
+        changed_values_long(old_df, new_df, diff).to_csv(args.changes_tsv, sep='\t', index=False)
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+import importlib.util
+from lookup_store import sql_name
+from nda_schema import check_columns, read_header, schema_dtypes
+from run_report import report_stage
+from source_registry import entry_dedupe, nda_date_format, plan_source_reads
+
+# DuckDB engine for make_participants_tsv.py (--engine duckdb)
+#   Every source file is registered as a lazily scanned view and the build is expressed as SQL: the fastqc01 key set, the
+#   registry's dedupe policies and left joins, the coalesce of baseline over longitudinal values, the derived columns, the
+#   remaps and the sentinel fills. DuckDB runs it on all cores within its memory limit, spilling to disk when needed and
+#   parsing only the projected columns of each file. The rows are returned in the pandas engine's merge order with the
+#   same column types, so sorting and writing them in pandas gives the same participants.tsv as the pandas engine.
+#   Columns outside the typed NDA schema are typed from the values of their whole file, as pandas.read_csv types them, in one
+#   scan of each file for all of its untyped columns. Columns are assumed to hold one type of value throughout their file, as
+#   pandas infers types per chunk of the master file.
+
+# DuckDB is optional, without it make_participants_tsv.py only offers the pandas engine
+duckdb_available = importlib.util.find_spec('duckdb') is not None
+
+# Strings pandas.read_csv reads as NaN by default, applied to every scan so both engines agree on the missing values
+pandas_na_values = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL',
+                    'NaN', 'None', 'n/a', 'nan', 'null']
+
+# Column numbering the rows of every scanned file in file order, used to return rows in the pandas engine's merge order
+row_column = 'source_row'
+
+# Hashmap of the dtypes of the typed NDA schema (see nda_schema.py) to the kind of the column pandas reads
+schema_kinds = {
+    'str': 'string',
+    'Int64': 'nullable_integer',
+    'float64': 'numeric'
+}
+
+
+# Quote a string literal for DuckDB SQL
+def sql_string(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+# Return a DOUBLE literal for DuckDB SQL
+def sql_double(value):
+    return f'CAST({float(value)!r} AS DOUBLE)'
+
+
+# Register a view lazily scanning columns of a delimited text file as strings, with the rows numbered in file order
+#   skip_rows: rows skipped after the header row (1 for the descriptor row of NDA Dictionary files)
+def register_scan(con, view, path, columns, delimiter, skip_rows=0):
+    header = read_header(path, delimiter)
+    check_columns(path, header, columns)
+    column_types = ', '.join(f"{sql_string(name)}: 'VARCHAR'" for name in header)
+    na_values = ', '.join(map(sql_string, pandas_na_values))
+    con.execute(f"CREATE VIEW {sql_name(view)} AS SELECT row_number() OVER () AS {row_column}, {', '.join(map(sql_name, columns))} "
+                f"FROM read_csv({sql_string(path)}, delim={sql_string(delimiter)}, quote='\"', escape='\"', header=false, skip={1 + skip_rows}, "
+                f"columns={{{column_types}}}, nullstr=[{na_values}], auto_detect=false)")
+
+
+# Return an expression of the row-wise max of column_exprs where the low_codes rank below every valid answer (see column_encoding.coded_max)
+def coded_max_sql(column_exprs, low_codes):
+    def ranked(expr):
+        return 'CASE ' + ' '.join(f'WHEN {expr} = {sql_double(code)} THEN {sql_double(rank)}' for code, rank in low_codes.items()) + f' ELSE {expr} END'
+    result = ranked(column_exprs[0])
+    for expr in column_exprs[1:]:
+        # A NULL on either side keeps the running result, like the pandas comparison with NaN
+        result = f'CASE WHEN {ranked(expr)} > {result} THEN {ranked(expr)} ELSE {result} END'
+    return 'CASE ' + ' '.join(f'WHEN {result} = {sql_double(rank)} THEN {sql_double(code)}' for code, rank in low_codes.items()) + f' ELSE {result} END'
+
+
+# SQL versions of the derive functions of column_encoding.py, called with the DOUBLE expressions of the spec's columns
+sql_derive_functions = {
+    'coded_max': coded_max_sql
+}
+
+
+# Return the SQL of a registry entry's projection: its columns renamed, its rows restricted to the qc keys and reduced by its dedupe policy
+def projection_sql(entry, view):
+    merge_on = entry['merge_on']
+    dedupe = entry_dedupe(entry)
+    columns = [f'{sql_name(col)} AS {sql_name(name)}' for col, name in entry['column_map'].items()]
+    order_by = dedupe.get('order_by')
+    order_expr = None
+    if order_by is not None:
+        order_expr = sql_name(entry['column_map'].get(order_by, '__order_by'))
+        if order_by not in entry['column_map']:
+            columns.append(f'{sql_name(order_by)} AS __order_by')
+    key_filter = ' AND '.join(f'{sql_name(col)} IS NOT NULL' for col in entry['column_map'] if entry['column_map'][col] in merge_on)
+    keys = ', '.join(map(sql_name, merge_on))
+    projection = (f"SELECT * FROM (SELECT {row_column}, {', '.join(columns)} FROM {sql_name(view)} WHERE {key_filter}) "
+                  f"SEMI JOIN (SELECT DISTINCT {keys} FROM qc) USING ({keys})")
+
+    if dedupe.get('policy') == 'latest':
+        # The latest date per key, the last row in file order among equal dates and unparseable dates last
+        order_date = f"try_strptime({order_expr}, {sql_string(dedupe.get('order_format', nda_date_format))})"
+        projection = (f"SELECT * FROM ({projection}) QUALIFY row_number() OVER (PARTITION BY {keys} "
+                      f"ORDER BY {order_date} DESC NULLS LAST, {row_column} DESC) = 1")
+    if order_by is not None and order_by not in entry['column_map']:
+        projection = f'SELECT * EXCLUDE (__order_by) FROM ({projection})'
+    if dedupe.get('policy') == 'first':
+        # The first non-null value of every column in file order, like a pandas group-by first
+        values = [f'arg_min({sql_name(name)}, {row_column}) FILTER (WHERE {sql_name(name)} IS NOT NULL) AS {sql_name(name)}'
+                  for name in entry['column_map'].values() if name not in merge_on]
+        projection = f"SELECT {keys}, min({row_column}) AS {row_column}, {', '.join(values)} FROM ({projection}) GROUP BY {keys}"
+    return projection
+
+
+# Raise the error of an entry with the 'error' dedupe policy when its projection has duplicate keys, as source_registry.dedupe_projection does
+def check_duplicate_keys(con, ctes, entry, projection):
+    keys = ', '.join(map(sql_name, entry['merge_on']))
+    duplicates_df = con.execute(f'WITH {ctes} SELECT {keys}, count(*) AS rows FROM ({projection}) GROUP BY {keys} HAVING count(*) > 1 '
+                                f'ORDER BY min({row_column})').df()
+    if len(duplicates_df):
+        examples = duplicates_df[entry['merge_on']].head(5).astype(str).to_dict(orient='records')
+        raise ValueError(f"{entry['name']} has {int(duplicates_df['rows'].sum())} rows with duplicate {entry['merge_on']} keys, e.g. {examples}")
+
+
+# Return the kind of every source column in view: 'integer' when pandas would read it as int64 (all values integers, none missing),
+#   'numeric' when it would read it as float64 and 'string' otherwise, from one scan of the view for all of the columns
+def column_kinds(con, view, columns):
+    if not columns:
+        return {}
+    checks = []
+    for col in columns:
+        checks.append(f'bool_and({sql_name(col)} IS NOT NULL AND regexp_full_match({sql_name(col)}, \'\\s*[+-]?[0-9]+\\s*\'))')
+        checks.append(f'bool_and({sql_name(col)} IS NULL OR TRY_CAST({sql_name(col)} AS DOUBLE) IS NOT NULL)')
+    results = con.execute(f"SELECT {', '.join(checks)} FROM {sql_name(view)}").fetchone()
+    kinds = {}
+    for i, col in enumerate(columns):
+        is_integer, is_numeric = results[2 * i] is not False, results[2 * i + 1] is not False
+        kinds[col] = 'integer' if is_integer else 'numeric' if is_numeric else 'string'
+    return kinds
+
+
+# Return the expression of a participants.tsv column after its column spec's remap, fill and dtype
+#   kind: 'int' for columns cast by their spec, else the kind of its source values (see column_kinds and schema_kinds)
+def encoded_sql(expr, spec, kind):
+    if 'remap' in spec:
+        expr = 'CASE ' + ' '.join(f'WHEN {expr} = {sql_string(key)} THEN {sql_string(value)}' for key, value in spec['remap'].items()) + ' END'
+    if kind == 'int':
+        return f"CAST(trunc(COALESCE(CAST({expr} AS DOUBLE), {sql_double(spec.get('fill'))})) AS BIGINT)" if 'fill' in spec else f'CAST(trunc(CAST({expr} AS DOUBLE)) AS BIGINT)'
+    if kind == 'numeric':
+        return f"COALESCE(CAST({expr} AS DOUBLE), {sql_double(spec['fill'])})" if 'fill' in spec else f'CAST({expr} AS DOUBLE)'
+    if kind == 'nullable_integer':
+        return f"COALESCE(CAST({expr} AS BIGINT), {int(spec['fill'])})" if 'fill' in spec else f'CAST({expr} AS BIGINT)'
+    if kind == 'integer':
+        # Filled in pandas, since pandas keeps these columns as integers only when no row is missing a value
+        return f'CAST({expr} AS BIGINT)'
+    return f"COALESCE({expr}, {sql_string(spec['fill'])})" if 'fill' in spec else expr
+
+
+# Build the participants.tsv rows with DuckDB, returning them in the pandas engine's row order (before its final sort) with the given columns
+#   workers and memory_limit set the DuckDB threads and memory limit (e.g. '8GB'), DuckDB's defaults are used when they are None
+def build_participants_duckdb(registry, fastqc01_path, c3165_manifest_path, c3165_associated_file_pattern, original_participants_path,
+                              bids_session_dict, column_specs, derived_columns, columns, workers=None, memory_limit=None, report=None):
+    import duckdb
+    con = duckdb.connect()
+    if workers is not None:
+        con.execute(f'SET threads = {int(workers)}')
+    if memory_limit is not None:
+        con.execute(f'SET memory_limit = {sql_string(memory_limit)}')
+
+    with report_stage(report, 'duckdb plan') as record:
+        register_scan(con, 'fastqc01', fastqc01_path, ['subjectkey', 'visit'], '\t', skip_rows=1)
+        register_scan(con, 'manifest', c3165_manifest_path, ['associated_file'], '\t')
+        register_scan(con, 'matched_groups', original_participants_path, ['participant_id', 'matched_group'], '\t')
+        read_plan = plan_source_reads(registry)
+        views = {}
+        for path, read in read_plan.items():
+            views[path] = f'source_{len(views)}'
+            master = read['reader'] == 'master'
+            register_scan(con, views[path], path, read['columns'], ',' if master else '\t', skip_rows=0 if master else 1)
+
+        # The unique fastqc01 keys in order of first appearance, as load_qc_subjects and merge_sources keep them
+        ctes = [f'qc AS (SELECT subjectkey AS participant_id, visit AS session_id, min({row_column}) AS qc_row FROM fastqc01 '
+                f'WHERE subjectkey IS NOT NULL AND visit IS NOT NULL GROUP BY ALL)']
+        unknown_sessions = con.execute(f'WITH {ctes[0]} SELECT DISTINCT session_id FROM qc').df()['session_id']
+        unknown_sessions = unknown_sessions[~unknown_sessions.isin(bids_session_dict.keys())]
+        if len(unknown_sessions):
+            raise ValueError(f'session_ids missing from bids_session_dict: {sorted(map(str, unknown_sessions))}')
+        participant_id = "'sub-' || replace(qc.participant_id, '_', '')"
+        session_id = 'CASE ' + ' '.join(f'WHEN qc.session_id = {sql_string(key)} THEN {sql_string(value)}' for key, value in bids_session_dict.items()) + ' END'
+
+        # Kinds of the value columns of every source file, from the NDA schema or else from one scan of the file for all of its untyped columns
+        typed_kinds = {path: {col: schema_kinds[dtype] for col, dtype in schema_dtypes(read_header(path, '\t')).items()} if read['reader'] == 'nda' else {}
+                       for path, read in read_plan.items()}
+        untyped_columns = {path: [] for path in read_plan}
+        for entry in registry:
+            for col, name in entry['column_map'].items():
+                if (name not in entry['merge_on'] and 'dtype' not in column_specs.get(name, {}) and col not in typed_kinds[entry['path']]
+                        and col not in untyped_columns[entry['path']]):
+                    untyped_columns[entry['path']].append(col)
+        source_kinds = {path: {**column_kinds(con, views[path], untyped_columns[path]), **typed_kinds[path]} for path in read_plan}
+
+        # Projection of every registry entry, and the expression of every participants.tsv column in registry order
+        joins = []
+        row_columns = []
+        values = {}
+        kinds = {}
+        projections = []
+        for i, entry in enumerate(registry):
+            projection = projection_sql(entry, views[entry['path']])
+            projections.append(projection)
+            ctes.append(f'p{i} AS ({projection})')
+            joins.append(f'LEFT JOIN p{i} ON ' + ' AND '.join(f'p{i}.{sql_name(col)} = qc.{sql_name(col)}' for col in entry['merge_on']))
+            row_columns.append(f'p{i}.{row_column}')
+            value_columns = {col: name for col, name in entry['column_map'].items() if name not in entry['merge_on']}
+            for col, name in value_columns.items():
+                if name in values and name not in entry.get('coalesce', []):
+                    raise ValueError(f"Registry entry {entry['name']} merges {name} over an earlier entry without listing it in coalesce")
+                # Overwrite the earlier entries' values wherever this entry's value is not NULL
+                values[name] = f'COALESCE(p{i}.{sql_name(name)}, {values[name]})' if name in values else f'p{i}.{sql_name(name)}'
+                kind = 'int' if 'dtype' in column_specs.get(name, {}) else source_kinds[entry['path']][col]
+                kinds[name] = kind if name not in kinds else 'string' if 'string' in (kind, kinds[name]) else 'numeric' if kind != kinds[name] else kind
+
+        # Collection 3165 subjects and sessions from the manifest's associated_file paths, and the matched groups in order of first appearance
+        ctes.append(f"c3165 AS (SELECT DISTINCT keys.participant_id, keys.session_id FROM (SELECT regexp_extract(associated_file, "
+                    f"{sql_string(c3165_associated_file_pattern.pattern)}, ['participant_id', 'session_id']) AS keys FROM manifest) "
+                    f"WHERE keys.participant_id <> '')")
+        ctes.append(f'matched AS (SELECT participant_id, matched_group, min({row_column}) AS {row_column} FROM matched_groups GROUP BY ALL)')
+        joins.append(f'LEFT JOIN c3165 ON c3165.participant_id = {participant_id} AND c3165.session_id = {session_id}')
+        joins.append(f'LEFT JOIN matched ON matched.participant_id = {participant_id}')
+        row_columns.append(f'matched.{row_column}')
+        values['collection_3165'] = "CASE WHEN c3165.participant_id IS NULL THEN NULL ELSE '1' END"
+        values['matched_group'] = 'matched.matched_group'
+
+        for name, spec in derived_columns.items():
+            options = {key: value for key, value in spec.items() if key not in ('derive', 'columns')}
+            values[name] = sql_derive_functions[spec['derive']]([f'CAST({values[col]} AS DOUBLE)' for col in spec['columns']], **options)
+            kinds[name] = 'numeric'
+
+        # Remapped columns hold the mapped strings, columns cast by their spec are 'int'
+        for name, spec in column_specs.items():
+            if 'remap' in spec:
+                kinds[name] = 'string'
+            if spec.get('dtype') == 'int':
+                kinds[name] = 'int'
+
+        # The values of every remapped column without a mapping are selected alongside the columns, to be checked once the rows are in
+        selected = [f'{participant_id} AS participant_id', f'{session_id} AS session_id']
+        selected += [f'{encoded_sql(values[name], column_specs.get(name, {}), kinds[name])} AS {sql_name(name)}' for name in columns[2:]]
+        remapped = [name for name, spec in column_specs.items() if 'remap' in spec]
+        selected += [f"CASE WHEN ({encoded_sql(values[name], {'remap': column_specs[name]['remap']}, 'string')}) IS NULL THEN {values[name]} END "
+                     f"AS {sql_name('__unmapped_' + name)}" for name in remapped]
+        query = (f"WITH {', '.join(ctes)} SELECT {', '.join(selected)} FROM qc {' '.join(joins)} "
+                 f"ORDER BY qc.qc_row, {', '.join(f'{col} NULLS FIRST' for col in row_columns)}")
+
+    with report_stage(report, 'duckdb query') as record:
+        participants_df = con.execute(query).df()
+        qc_rows = con.execute(f'WITH {ctes[0]} SELECT count(*) FROM qc').fetchone()[0]
+        record['rows_in'] = qc_rows
+        record['rows_out'] = len(participants_df)
+        record['fanout_rows'] = len(participants_df) - qc_rows
+        # Projections are restricted to the qc keys, so duplicate keys in any of them add rows: only then are the projections of
+        #   the entries with the 'error' dedupe policy checked, raising the error of the first with duplicate keys
+        if record['fanout_rows']:
+            for entry, projection in zip(registry, projections):
+                if entry_dedupe(entry)['policy'] == 'error':
+                    check_duplicate_keys(con, ', '.join(ctes), entry, projection)
+        if record['fanout_rows'] and report is not None and report['abort_on_fanout']:
+            raise ValueError(f"The merges added {record['fanout_rows']} rows through duplicate keys, run the pandas engine with --report to find the source")
+
+    for name in remapped:
+        unmapped = participants_df.pop('__unmapped_' + name).dropna().unique()
+        if len(unmapped):
+            raise ValueError(f'{name} has values without a mapping: {sorted(map(str, unmapped))}')
+
+    # Columns of integers without missing values stay integers, like pandas after a merge that matched every row
+    for name in columns[2:]:
+        if kinds[name] == 'integer':
+            if participants_df[name].isna().any():
+                participants_df[name] = participants_df[name].astype('float64').fillna(column_specs.get(name, {}).get('fill'))
+            else:
+                participants_df[name] = participants_df[name].astype('int64')
+        elif kinds[name] == 'nullable_integer':
+            participants_df[name] = participants_df[name].astype('Int64')
+    con.close()
+    return participants_df
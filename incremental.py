@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+import hashlib
+import io
+import json
+import os
+import numpy as np
+import pandas as pd
+from atomic_files import write_file_atomic, write_text_atomic
+from nda_cache import file_sha256
+from source_registry import dedupe_projection, entry_dedupe, split_projection
+
+# Incremental rebuild support for make_participants_tsv.py
+#   Every build records a build state next to participants.tsv: the size, mtime and sha256 of each registry source file
+#   and a digest of each registry entry's projection per key. An incremental build compares the current source files and
+#   digests against that state to find the (participant_id, session_id) rows that have to be recomputed, rebuilds only
+#   those rows and splices them into the prior participants.tsv.
+
+key_columns = ['participant_id', 'session_id']
+
+
+# Return the paths of the build state json and the projection digests written next to a participants.tsv
+def build_state_paths(participants_path):
+    base_path = os.path.splitext(participants_path)[0]
+    return base_path + '_build_state.json', base_path + '_build_digests.tsv.gz'
+
+
+# Return the size, mtime and sha256 of a source file
+def source_fingerprint(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_sha256(path)}
+
+
+# Return True if the source file at path no longer matches its fingerprint in the build state, hashing it only when its size or mtime changed
+def source_changed(path, fingerprint):
+    if fingerprint is None:
+        return True
+    stat = os.stat(path)
+    if stat.st_size != fingerprint['size']:
+        return True
+    if stat.st_mtime_ns == fingerprint['mtime_ns']:
+        return False
+    return file_sha256(path) != fingerprint['sha256']
+
+
+# Return the sha256 of a registry entry's spec, so edits to its column_map, dedupe policy or coalesce list are detected
+#   The dedupe policy is hashed as applied, so a change of the default dedupe policy is detected too
+def entry_digest(entry):
+    return hashlib.sha256(json.dumps({**entry, 'dedupe': entry_dedupe(entry)}, sort_keys=True).encode()).hexdigest()
+
+
+# Return the names of the registry entries whose spec differs from the one recorded in the build state, and of the recorded
+#   entries no longer in the registry. Build states recorded without entry specs count every entry as changed.
+def changed_entry_specs(registry, state):
+    recorded = state.get('entries', {})
+    registry_names = [entry['name'] for entry in registry]
+    changed = [entry['name'] for entry in registry if recorded.get(entry['name']) != entry_digest(entry)]
+    return changed + [name for name in recorded if name not in registry_names]
+
+
+# Load the build state recorded next to a participants.tsv, returning empty state if none was recorded
+def load_build_state(participants_path):
+    state_path, digests_path = build_state_paths(participants_path)
+    if not (os.path.exists(state_path) and os.path.exists(digests_path)):
+        return {'sources': {}}, pd.DataFrame(columns=['entry', *key_columns, 'digest'])
+    with open(state_path) as f:
+        state = json.load(f)
+    digests_df = pd.read_csv(digests_path, sep='\t', dtype=str, keep_default_na=False)
+    return state, digests_df
+
+
+# Write the build state of the registry sources and entry specs and the projection digests next to a participants.tsv
+def write_build_state(participants_path, registry, digests_df):
+    state_path, digests_path = build_state_paths(participants_path)
+    sources = {}
+    for entry in registry:
+        if entry['path'] not in sources:
+            sources[entry['path']] = source_fingerprint(entry['path'])
+    write_file_atomic(digests_path, lambda tmp_path: digests_df.to_csv(tmp_path, sep='\t', index=False, compression='gzip'))
+    entries = {entry['name']: entry_digest(entry) for entry in registry}
+    write_text_atomic(state_path, json.dumps({'sources': sources, 'entries': entries}, indent=2))
+
+
+# Remove the build state recorded next to a participants.tsv built without projection digests, so an incremental build from it
+#   treats every source file as changed instead of trusting the state of an earlier build
+def clear_build_state(participants_path):
+    for path in build_state_paths(participants_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# Return one digest per key of every registry entry's projection in source_dfs, restricted to the keys in key_df
+#   Subject level entries (merged on participant_id only) have an empty session_id. Projections are reduced by their dedupe policy first,
+#   keys left with several rows get the sum of their row hashes
+def projection_digests(registry, source_dfs, key_df):
+    digest_dfs = [pd.DataFrame(columns=['entry', *key_columns, 'digest'])]
+    for entry in registry:
+        if entry['path'] not in source_dfs:
+            continue
+        merge_on = entry['merge_on']
+        projection_df = split_projection(source_dfs[entry['path']], entry)
+        key_index = pd.MultiIndex.from_frame(key_df[merge_on].drop_duplicates())
+        projection_df = projection_df[pd.MultiIndex.from_frame(projection_df[merge_on]).isin(key_index)]
+        projection_df = dedupe_projection(projection_df, entry)
+
+        row_hashes = pd.util.hash_pandas_object(projection_df, index=False)
+        digest_df = projection_df[merge_on].assign(digest=row_hashes.values).groupby(merge_on, sort=False)['digest'].sum().reset_index()
+        digest_df['digest'] = digest_df['digest'].astype(str)
+        if 'session_id' not in merge_on:
+            digest_df['session_id'] = ''
+        digest_df['entry'] = entry['name']
+        digest_dfs.append(digest_df[['entry', *key_columns, 'digest']])
+    return pd.concat(digest_dfs, ignore_index=True)
+
+
+# Return the rows of key_df whose digest differs between prior_digests and current_digests for the given registry entries
+#   A changed subject level digest marks every session of that participant
+def changed_keys(key_df, prior_digests, current_digests, entry_names):
+    prior_digests = prior_digests[prior_digests['entry'].isin(entry_names)]
+    current_digests = current_digests[current_digests['entry'].isin(entry_names)]
+    digests = pd.merge(prior_digests, current_digests, how='outer', on=['entry', *key_columns], suffixes=('_prior', '_current'))
+    changed = digests[digests['digest_prior'] != digests['digest_current']]
+
+    changed_sessions = pd.MultiIndex.from_frame(changed.loc[changed['session_id'] != '', key_columns])
+    changed_participants = changed.loc[changed['session_id'] == '', 'participant_id']
+    mask = pd.MultiIndex.from_frame(key_df[key_columns]).isin(changed_sessions) | key_df['participant_id'].isin(changed_participants)
+    return key_df[mask]
+
+
+# Return participants_df as the text participants.tsv holds, so rebuilt rows compare and splice exactly with a prior participants.tsv
+def as_written(participants_df):
+    buffer = io.StringIO()
+    participants_df.to_csv(buffer, sep='\t', index=False)
+    buffer.seek(0)
+    return pd.read_csv(buffer, sep='\t', dtype=str, keep_default_na=False)
+
+
+# Load a prior participants.tsv as text
+def load_prior_participants(path, columns):
+    prior_df = pd.read_csv(path, sep='\t', dtype=str, keep_default_na=False)
+    if list(prior_df.columns) != list(columns):
+        raise ValueError(f'{path} does not have the current participants.tsv columns, run a full build instead')
+    return prior_df
+
+
+# Return the keys of participants_df whose values in the given columns differ from the prior participants.tsv
+#   participants_df must be in the text form returned by as_written
+def changed_values(prior_df, participants_df, columns):
+    compared = pd.merge(participants_df[key_columns + columns], prior_df[key_columns + columns].drop_duplicates(key_columns),
+                        how='inner', on=key_columns, suffixes=('', '_prior'))
+    mask = pd.Series(False, index=compared.index)
+    for col in columns:
+        mask |= compared[col] != compared[col + '_prior']
+    return compared.loc[mask, key_columns]
+
+
+# Splice the rebuilt rows into the prior participants.tsv
+#   Prior rows missing from current_keys are removed, prior rows of rebuilt keys are replaced and rebuilt rows for new keys are added.
+#   The rows are ordered as a full build orders them: in the order of their keys in current_keys (the merge order), rows of the
+#   same key keeping their order, then sorted A to Z by participant_id with the full build's sort.
+def splice_participants(prior_df, rebuilt_df, current_keys):
+    prior_index = pd.MultiIndex.from_frame(prior_df[key_columns])
+    current_index = pd.MultiIndex.from_frame(current_keys[key_columns])
+    keep = prior_index.isin(current_index) & ~prior_index.isin(pd.MultiIndex.from_frame(rebuilt_df[key_columns]))
+    spliced_df = pd.concat([prior_df[keep], rebuilt_df], ignore_index=True)
+    positions = current_index.get_indexer(pd.MultiIndex.from_frame(spliced_df[key_columns]))
+    spliced_df = spliced_df.iloc[np.argsort(positions, kind='stable')]
+    return spliced_df.sort_values(by='participant_id', ignore_index=True)
+
+
+# Return a changelog of the rows added, changed and removed between the prior participants.tsv and the spliced result
+#   Changed rows list the columns whose values differ
+def participants_changelog(prior_df, spliced_df, rebuilt_df):
+    prior_index = pd.MultiIndex.from_frame(prior_df[key_columns])
+    spliced_index = pd.MultiIndex.from_frame(spliced_df[key_columns])
+    added = rebuilt_df[~pd.MultiIndex.from_frame(rebuilt_df[key_columns]).isin(prior_index)]
+    removed = prior_df[~prior_index.isin(spliced_index)]
+
+    value_columns = [col for col in prior_df.columns if col not in key_columns]
+    compared = pd.merge(rebuilt_df, prior_df.drop_duplicates(key_columns), how='inner', on=key_columns, suffixes=('', '_prior'))
+    differs = pd.DataFrame({col: compared[col] != compared[col + '_prior'] for col in value_columns}, index=compared.index)
+    changed = []
+    for row_index in compared.index[differs.any(axis=1)]:
+        changed.append({
+            'participant_id': compared.at[row_index, 'participant_id'],
+            'session_id': compared.at[row_index, 'session_id'],
+            'columns': [col for col in value_columns if differs.at[row_index, col]]
+        })
+
+    return {
+        'added': added[key_columns].to_dict(orient='records'),
+        'changed': changed,
+        'removed': removed[key_columns].to_dict(orient='records')
+    }
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+from urllib.request import pathname2url
+from atomic_files import create_temp_file
+
+# Indexed SQLite lookup store of participants.tsv (table participants) and main_lookup.csv (table lookup)
+#   make_participants_tsv.py and make_lookup.py write the store next to their outputs, so one subject's ids or one session's
+#   demographics are read through an index in milliseconds instead of loading or grepping the whole file. Only the standard
+#   library is used to read the store, so lookups do not pay for importing pandas.
+#     python lookup_store.py participants.sqlite sub-NDARINV00000000 --session ses-baselineYear1Arm1
+#     python lookup_store.py main_lookup.sqlite NDAR_INV00000000 INV11111111 --subject
+
+# Hashmap of store table to its session column and the column lists it is indexed on, the first index leading with its default lookup column
+store_tables = {
+    'participants': {
+        'session_column': 'session_id',
+        'indexes': [['participant_id', 'session_id']]
+    },
+    'lookup': {
+        'session_column': 'bids_session_id',
+        'indexes': [['bids_subject_id', 'bids_session_id'], ['subjectkey'], ['src_subject_id']]
+    }
+}
+
+# Columns of the lookup table holding the ids of a subject, resolved to each other by find_subjects
+subject_id_columns = ['bids_subject_id', 'subjectkey', 'src_subject_id']
+
+# Values per query in batch lookups, below SQLite's limit on query parameters
+batch_size = 500
+
+
+# Quote a table, view or column name for SQLite and DuckDB SQL, which quote names the same way
+def sql_name(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+# Open a new store at a temporary path next to path, returning the connection and the temporary path for finish_store
+def create_store(path):
+    tmp_path = create_temp_file(path)
+    con = sqlite3.connect(tmp_path)
+    # The store is rebuilt from scratch and renamed into place, so the journal only slows the bulk inserts down
+    con.execute('PRAGMA journal_mode = OFF')
+    con.execute('PRAGMA synchronous = OFF')
+    return con, tmp_path
+
+
+# Append the rows of a dataframe to a store table, storing object columns as text
+def append_rows(con, table, rows_df):
+    text_columns = [col for col in rows_df.columns if rows_df[col].dtype == object]
+    if text_columns:
+        rows_df = rows_df.copy()
+        rows_df[text_columns] = rows_df[text_columns].apply(lambda column: column.where(column.isna(), column.astype(str)))
+    rows_df.to_sql(table, con, index=False, if_exists='append')
+
+
+# Index the tables of a store opened by create_store and rename it into place at path
+def finish_store(con, tmp_path, path):
+    try:
+        tables = [row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        for table in tables:
+            for columns in store_tables.get(table, {}).get('indexes', []):
+                con.execute(f"CREATE INDEX {sql_name(table + '_' + '_'.join(columns))} ON {sql_name(table)} ({', '.join(map(sql_name, columns))})")
+        con.execute('ANALYZE')
+        con.commit()
+    finally:
+        con.close()
+    os.replace(tmp_path, path)
+
+
+# Write a dataframe as the only table of a new store at path
+def write_store(path, table, rows_df):
+    con, tmp_path = create_store(path)
+    try:
+        append_rows(con, table, rows_df)
+    except BaseException:
+        con.close()
+        os.remove(tmp_path)
+        raise
+    finish_store(con, tmp_path, path)
+
+
+# Open a store read-only, with rows returned as sqlite3.Row
+def open_store(path):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'No lookup store at {path}')
+    con = sqlite3.connect(f'file:{pathname2url(os.path.abspath(path))}?mode=ro', uri=True)
+    con.row_factory = sqlite3.Row
+    return con
+
+
+# Return the columns of a store table, raising a ValueError for tables that are not in the store
+def table_columns(con, table):
+    columns = [row['name'] for row in con.execute(f'PRAGMA table_info({sql_name(table)})')]
+    if not columns:
+        raise ValueError(f'Table {table} not found in the lookup store')
+    return columns
+
+
+# Return the rows of a store table whose column matches any of values as dicts, in the order of values
+#   session: optional session to restrict the rows to, matched against the table's session column
+def lookup(con, table, column, values, session=None):
+    columns = table_columns(con, table)
+    if column not in columns:
+        raise ValueError(f'Column {column} not found in table {table}, expected one of {columns}')
+    session_filter = ''
+    session_params = []
+    if session is not None:
+        session_filter = f" AND {sql_name(store_tables[table]['session_column'])} = ?"
+        session_params = [session]
+
+    # Values are matched as text, SQLite converts them to the column's type in the comparison
+    values = list(dict.fromkeys(map(str, values)))
+    rows_by_value = {value: [] for value in values}
+    for start in range(0, len(values), batch_size):
+        batch = values[start:start + batch_size]
+        query = f"SELECT * FROM {sql_name(table)} WHERE {sql_name(column)} IN ({', '.join('?' * len(batch))}){session_filter} ORDER BY rowid"
+        for row in con.execute(query, batch + session_params):
+            rows_by_value.setdefault(str(row[column]), []).append(dict(row))
+    return [row for rows in rows_by_value.values() for row in rows]
+
+
+# Return the distinct (bids_subject_id, subjectkey, src_subject_id) of the lookup table matching any of subject_ids,
+#   each of which may be any of the three ids
+def find_subjects(con, subject_ids):
+    subjects = {}
+    for column in subject_id_columns:
+        for row in lookup(con, 'lookup', column, subject_ids):
+            subjects.setdefault(tuple(row[col] for col in subject_id_columns), None)
+    return [dict(zip(subject_id_columns, subject)) for subject in subjects]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Look up subjects and sessions in a participants.tsv or main_lookup.csv lookup store')
+    parser.add_argument('store', help='Lookup store written by make_participants_tsv.py or make_lookup.py')
+    parser.add_argument('values', nargs='*', help='Values of the --by column to look up')
+    parser.add_argument('--values-file', help='Also look up the values listed one per line in this file')
+    parser.add_argument('--table', help='Table to look up, by default the only table of the store')
+    parser.add_argument('--by', help="Column to look the values up in, by default the table's first indexed column")
+    parser.add_argument('--session', help='Only return rows of this BIDS session')
+    parser.add_argument('--subject', action='store_true',
+                        help='Resolve each value, a BIDS subject id, subjectkey or src_subject_id, to all three ids (lookup table)')
+    parser.add_argument('--json', action='store_true', help='Print the rows as json instead of tab separated values')
+    args = parser.parse_args()
+
+    values = list(args.values)
+    if args.values_file:
+        with open(args.values_file) as f:
+            values += [line.strip() for line in f if line.strip()]
+
+    con = open_store(args.store)
+    if args.subject:
+        rows = find_subjects(con, values)
+    else:
+        table = args.table
+        if table is None:
+            tables = [row['name'] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+            if len(tables) != 1:
+                parser.error(f'The store has the tables {tables}, pick one with --table')
+            table = tables[0]
+        by = args.by or store_tables.get(table, {}).get('indexes', [[table_columns(con, table)[0]]])[0][0]
+        rows = lookup(con, table, by, values, args.session)
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    elif rows:
+        writer = csv.DictWriter(sys.stdout, fieldnames=list(rows[0]), delimiter='\t', lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+    if not rows:
+        sys.exit(f'No rows found for {values}')
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import os
+import numpy as np
+import pandas as pd
+import make_participants_tsv as mpt
+
+# Synthetic NDA-format fixtures for running and benchmarking make_participants_tsv.py without the restricted source files
+#   Every source in make_participants_tsv.py is written under its own file name into one fixtures directory:
+#     NDA Dictionary files are tab-delimited with the column names, a descriptor row and quoted values
+#     the master data file is a wide comma-delimited csv with one row per subject and eventname
+#     the 3165 manifest lists associated_file paths for the imaging sessions
+#   Sources with several rows per key (fastqc01 series, family history and MRI info revisions) get duplicate rows.
+
+# Eventnames of the imaging sessions, the sessions with fastqc01, MRI info and manifest rows
+imaging_eventnames = ['baseline_year_1_arm_1', '2_year_follow_up_y_arm_1', '4_year_follow_up_y_arm_1']
+
+# Characters of the 8 character NDAR GUID suffix
+guid_characters = np.array(list('ABCDEFGHJKLMNPRTUVWXYZ0123456789'))
+
+# Values of the coded NDA Dictionary columns
+race_columns = [col for col in mpt.nda_dict_demo_map_invariable if col.startswith('demo_race_a_p___')]
+education_codes = [*range(0, 22), 777, 999]
+income_codes = [*range(1, 11), 777, 999]
+scanner_models = {
+    'SIEMENS': ['Prisma', 'Prisma_fit'],
+    'GE MEDICAL SYSTEMS': ['DISCOVERY MR750'],
+    'Philips Medical Systems': ['Achieva dStream', 'Ingenia']
+}
+
+
+# Return the fixture path of a source file, keeping its file name
+def fixture_path(fixtures_dir, source_path):
+    return os.path.join(fixtures_dir, os.path.basename(source_path))
+
+
+# Return a copy of the make_participants_tsv.py registry and source paths pointing at the fixtures directory
+def fixture_sources(fixtures_dir):
+    return {
+        'registry': [dict(entry, path=fixture_path(fixtures_dir, entry['path'])) for entry in mpt.source_registry],
+        'fastqc01_path': fixture_path(fixtures_dir, mpt.fastqc01_path),
+        'c3165_manifest_path': fixture_path(fixtures_dir, mpt.c3165_manifest_path),
+        # The original participants.tsv is renamed so it can not be mistaken for a build output
+        'original_participants_path': os.path.join(fixtures_dir, 'participants_v1.0.0.tsv')
+    }
+
+
+# Write a dataframe as an NDA Dictionary file: the column names, a descriptor row and the rows with every value quoted
+def write_nda_file(path, df):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', quoting=csv.QUOTE_ALL, lineterminator='\n')
+        writer.writerow(df.columns)
+        writer.writerow([f'Description of {col}' for col in df.columns])
+        df.to_csv(f, sep='\t', index=False, header=False, quoting=csv.QUOTE_ALL, na_rep='')
+
+
+# Return n random values from choices with a fraction of them missing
+def coded_values(rng, choices, n, missing_rate=0.05):
+    values = pd.Series(rng.choice(choices, n)).astype(object)
+    values[rng.random(n) < missing_rate] = None
+    return values
+
+
+# Return a dataframe of the rows of key_df with a random fraction of them repeated
+def with_duplicates(rng, key_df, duplicate_rate):
+    duplicates = key_df[rng.random(len(key_df)) < duplicate_rate]
+    return pd.concat([key_df, duplicates], ignore_index=True)
+
+
+# Return n unique NDAR subjectkeys
+def make_subjectkeys(rng, n):
+    subjectkeys = set()
+    while len(subjectkeys) < n:
+        suffixes = rng.choice(guid_characters, (n - len(subjectkeys), 8))
+        subjectkeys.update('NDAR_INV' + ''.join(suffix) for suffix in suffixes)
+    return np.array(sorted(subjectkeys))
+
+
+# Write every fixture for n_subjects subjects into fixtures_dir
+#   master_columns: number of extra columns in the master data file on top of the ones make_participants_tsv.py reads
+#   duplicate_rate: fraction of keys given a second row in the sources with several rows per key
+def make_fixtures(fixtures_dir, n_subjects, master_columns=200, duplicate_rate=0.02, seed=0):
+    rng = np.random.default_rng(seed)
+    sources = fixture_sources(fixtures_dir)
+    paths = {entry['name']: entry['path'] for entry in sources['registry']}
+    os.makedirs(fixtures_dir, exist_ok=True)
+
+    subjectkeys = make_subjectkeys(rng, n_subjects)
+    src_subject_ids = np.char.replace(subjectkeys.astype(str), 'NDAR_', '')
+    subjects_df = pd.DataFrame({'subjectkey': subjectkeys, 'src_subject_id': src_subject_ids})
+    eventnames = list(mpt.bids_session_dict)
+    interview_dates = pd.Series(pd.date_range('2016-09-01', '2022-12-31').strftime('%m/%d/%Y'))
+
+    # Every subject has a subset of the eventnames, and a subset of the imaging sessions
+    sessions_df = subjects_df.merge(pd.DataFrame({'eventname': eventnames}), how='cross')
+    sessions_df = sessions_df[(sessions_df['eventname'] == eventnames[0]) | (rng.random(len(sessions_df)) < 0.85)].reset_index(drop=True)
+    sessions_df['interview_date'] = interview_dates.sample(len(sessions_df), replace=True, random_state=seed).values
+    sessions_df['interview_age'] = rng.integers(107, 180, len(sessions_df)) + sessions_df['eventname'].map({name: i * 6 for i, name in enumerate(eventnames)})
+    imaging_df = sessions_df[sessions_df['eventname'].isin(imaging_eventnames) & (rng.random(len(sessions_df)) < 0.85)].reset_index(drop=True)
+    baseline_df = sessions_df[sessions_df['eventname'] == eventnames[0]].reset_index(drop=True)
+    followup_df = sessions_df[sessions_df['eventname'] != eventnames[0]].reset_index(drop=True)
+    sex = pd.Series(rng.choice(['M', 'F'], n_subjects), index=subjectkeys)
+
+    # fastqc01: one row per series, several series per imaging session
+    qc_df = imaging_df.loc[imaging_df.index.repeat(rng.integers(1, 5, len(imaging_df))), ['subjectkey', 'src_subject_id', 'eventname', 'interview_date', 'interview_age']]
+    qc_df = qc_df.rename(columns={'eventname': 'visit'})
+    qc_df['sex'] = sex[qc_df['subjectkey']].values
+    qc_df['ftq_series_id'] = np.arange(len(qc_df))
+    qc_df['ftq_usable'] = rng.integers(0, 2, len(qc_df))
+    write_nda_file(sources['fastqc01_path'], qc_df)
+
+    # Master data file: every column make_participants_tsv.py reads plus master_columns filler columns
+    master_df = sessions_df[['subjectkey', 'src_subject_id', 'eventname', 'interview_date', 'interview_age']].copy()
+    master_df['sex'] = sex[master_df['subjectkey']].values
+    master_df['ehi_handedness'] = coded_values(rng, [1, 2, 3], len(master_df))
+    for col in ['neurocog_pc1.bl', 'neurocog_pc2.bl', 'neurocog_pc3.bl']:
+        master_df[col] = np.round(rng.normal(0, 1, len(master_df)), 6)
+        master_df.loc[rng.random(len(master_df)) < 0.1, col] = np.nan
+    # Filler columns are added in a single concat, inserting hundreds of columns one at a time fragments the dataframe
+    filler_columns = {f'master_var_{i}': rng.integers(0, 1000, len(master_df)) if i % 2 else np.round(rng.random(len(master_df)), 4) for i in range(master_columns)}
+    master_df = pd.concat([master_df, pd.DataFrame(filler_columns, index=master_df.index)], axis=1)
+    master_df.to_csv(paths['tabulated_data'], index=False)
+
+    # pdem02: one baseline row per subject with the invariable and baseline demographics
+    demo_df = baseline_df[['subjectkey', 'src_subject_id', 'eventname', 'interview_date', 'interview_age']].copy()
+    demo_df['sex'] = sex[demo_df['subjectkey']].values
+    demo_df['demo_sex_v2'] = coded_values(rng, [1, 2, 3], len(demo_df))
+    for col in race_columns:
+        demo_df[col] = coded_values(rng, [0, 1], len(demo_df))
+    demo_df['demo_ethn_v2'] = coded_values(rng, [1, 2, 777, 999], len(demo_df))
+    demo_df['demo_comb_income_v2'] = coded_values(rng, income_codes, len(demo_df))
+    demo_df['demo_prnt_ed_v2'] = coded_values(rng, education_codes, len(demo_df))
+    demo_df['demo_prtnr_ed_v2'] = coded_values(rng, education_codes, len(demo_df), missing_rate=0.2)
+    demo_df['demo_ed_v2'] = coded_values(rng, range(0, 6), len(demo_df))
+    write_nda_file(paths['nda_dict_demo_invariable'], demo_df)
+
+    # abcd_lpds01: the follow-up demographics
+    demo_long_df = followup_df[['subjectkey', 'src_subject_id', 'eventname', 'interview_date', 'interview_age']].copy()
+    demo_long_df['demo_ed_v2_l'] = coded_values(rng, range(0, 12), len(demo_long_df), missing_rate=0.3)
+    demo_long_df['demo_prnt_ed_v2_l'] = coded_values(rng, education_codes, len(demo_long_df), missing_rate=0.3)
+    demo_long_df['demo_prtnr_ed_v2_l'] = coded_values(rng, education_codes, len(demo_long_df), missing_rate=0.4)
+    demo_long_df['demo_comb_income_v2_l'] = coded_values(rng, income_codes, len(demo_long_df), missing_rate=0.3)
+    write_nda_file(paths['nda_dict_demo_long'], demo_long_df)
+
+    # fhxp102: one row per subject, with duplicates
+    twin_df = with_duplicates(rng, baseline_df[['subjectkey', 'src_subject_id', 'eventname', 'interview_date', 'interview_age']], duplicate_rate)
+    twin_df['fhx_3c_sibs_same_birth'] = coded_values(rng, [0, 1, 999], len(twin_df))
+    write_nda_file(paths['nda_dict_twin'], twin_df)
+
+    # abcd_lt01: the site of every session
+    site_df = sessions_df[['subjectkey', 'src_subject_id', 'eventname', 'interview_date', 'interview_age']].copy()
+    site_df['site_id_l'] = pd.Series(rng.integers(1, 23, len(site_df))).map('site{:02d}'.format).values
+    write_nda_file(paths['nda_dict_site'], site_df)
+
+    # abcd_lssmh01 and abcd_medhxss01: the longitudinal and baseline anesthesia exposure
+    anes_long_df = followup_df[['subjectkey', 'src_subject_id', 'eventname', 'interview_date', 'interview_age']].copy()
+    anes_long_df['medhx_ss_9b_p_l'] = coded_values(rng, [0, 1], len(anes_long_df))
+    write_nda_file(paths['nda_dict_anes_long'], anes_long_df)
+    anes_base_df = baseline_df[['subjectkey', 'src_subject_id', 'eventname', 'interview_date', 'interview_age']].copy()
+    anes_base_df['medhx_ss_9b_p'] = coded_values(rng, [0, 1], len(anes_base_df))
+    write_nda_file(paths['nda_dict_anes_base'], anes_base_df)
+
+    # abcd_mri01: the scanner of every imaging session, with duplicates
+    mri_df = with_duplicates(rng, imaging_df[['subjectkey', 'src_subject_id', 'eventname', 'interview_date', 'interview_age']], duplicate_rate)
+    manufacturers = rng.choice(list(scanner_models), len(mri_df))
+    mri_df['mri_info_manufacturer'] = manufacturers
+    mri_df['mri_info_manufacturersmn'] = [scanner_models[manufacturer][i % len(scanner_models[manufacturer])] for i, manufacturer in enumerate(manufacturers)]
+    mri_df['mri_info_softwareversion'] = coded_values(rng, list(mpt.scanner_software_dict), len(mri_df))
+    write_nda_file(paths['mri_info'], mri_df)
+
+    # 3165 manifest: several files for most imaging sessions, plus files outside any subject directory
+    bids_subjects = 'sub-' + imaging_df['subjectkey'].str.replace('_', '', regex=False)
+    bids_sessions = imaging_df['eventname'].map(mpt.bids_session_dict)
+    collection_df = pd.DataFrame({'subject': bids_subjects, 'session': bids_sessions})[rng.random(len(imaging_df)) < 0.9]
+    collection_df = collection_df.loc[collection_df.index.repeat(rng.integers(1, 8, len(collection_df)))].reset_index(drop=True)
+    submission_ids = rng.integers(10000, 99999, len(collection_df)).astype(str)
+    associated_files = ('s3://NDAR_Central_1/submission_' + pd.Series(submission_ids) + '/derivatives/abcd-hcp-pipeline/'
+                        + collection_df['subject'] + '/' + collection_df['session'] + '/func/' + collection_df['subject'] + '_'
+                        + collection_df['session'] + '_run-' + pd.Series(np.arange(len(collection_df)) % 8).astype(str) + '_bold.nii.gz')
+    associated_files = pd.concat([associated_files, pd.Series(['s3://NDAR_Central_1/submission_00000/README.md', 's3://NDAR_Central_1/submission_00000/dataset_description.json'])], ignore_index=True)
+    manifest_df = pd.DataFrame({
+        'manifest_name': 'collection_3165_manifest.json',
+        'manifest_repository': 'NDAR_Central_1',
+        'associated_file': associated_files
+    })
+    write_nda_file(sources['c3165_manifest_path'], manifest_df)
+
+    # participants_v1.0.0: the matched group of most subjects, repeated on each of their sessions
+    original_df = pd.DataFrame({'participant_id': bids_subjects, 'session_id': bids_sessions})
+    matched_groups = pd.Series(rng.integers(1, 4, n_subjects), index='sub-' + np.char.replace(subjectkeys.astype(str), '_', ''))
+    original_df['matched_group'] = matched_groups[original_df['participant_id']].values
+    original_df = original_df[original_df['participant_id'].isin(matched_groups.index[rng.random(n_subjects) < 0.9])]
+    original_df.to_csv(sources['original_participants_path'], sep='\t', index=False)
+
+    return sources
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic NDA-format fixtures for make_participants_tsv.py')
+    parser.add_argument('fixtures_dir', help='Directory to write the fixtures to')
+    parser.add_argument('--subjects', type=int, default=10000, help='Number of subjects (default: 10000)')
+    parser.add_argument('--master-columns', type=int, default=200, help='Number of extra columns in the master data file (default: 200)')
+    parser.add_argument('--duplicate-rate', type=float, default=0.02, help='Fraction of keys given duplicate rows in fhxp102 and mri01 (default: 0.02)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0)')
+    args = parser.parse_args()
+
+    make_fixtures(args.fixtures_dir, args.subjects, args.master_columns, args.duplicate_rate, args.seed)
+    print(f'Wrote fixtures for {args.subjects} subjects to {args.fixtures_dir}')
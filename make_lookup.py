@@ -1,9 +1,18 @@
 #!/usr/bin/env python3
 
-import pandas as pd
+import argparse
 import csv
+import os
+import pandas as pd
+from atomic_files import create_temp_file
+from lookup_store import append_rows, create_store, finish_store
+
+# Reduced master data file the lookup is built from and the lookup written out
+master_path = '/home/rando149/shared/data/Collection_3165_Supporting_Documentation/ABCD2.0_MASTER_DATA_FILE_2.2.22_reduced.csv'
+lookup_path = 'main_lookup.csv'
 
-master_df = pd.read_csv('/home/rando149/shared/data/Collection_3165_Supporting_Documentation/ABCD2.0_MASTER_DATA_FILE_2.2.22_reduced.csv')
+# Number of rows of the master data file held in memory at once
+chunksize = 100000
 
 bids_session_dict = {
     'baseline_year_1_arm_1': 'ses-baselineYear1Arm1',
@@ -13,35 +22,88 @@ bids_session_dict = {
     '2_year_follow_up_y_arm_1':'ses-2YearFollowUpYArm1',
     '30_month_follow_up_arm_1': 'ses-30MonthFollowUpArm1',
     '3_year_follow_up_y_arm_1': 'ses-3YearFollowUpYArm1',
-    '42_month_follow_up_arm_1': 'ses-42MonthFollowUpArm1'
+    '42_month_follow_up_arm_1': 'ses-42MonthFollowUpArm1',
+    '4_year_follow_up_y_arm_1': 'ses-4YearFollowUpYArm1'
 }
 
-lookup_df = pd.DataFrame(columns = ['bids_subject_id', 
-                                    'bids_session_id',
-                                    'subjectkey',
-                                    'src_subject_id',
-                                    'interview_date',
-                                    'interview_age',
-                                    'sex'])
+lookup_columns = ['bids_subject_id',
+                  'bids_session_id',
+                  'subjectkey',
+                  'src_subject_id',
+                  'interview_date',
+                  'interview_age',
+                  'sex']
 
 # Additional columns
 # neurocog_pc1.bl
 # neurocog_pc2.bl
 # neurocog_pc3.bl
 
-for index, row in master_df.iterrows():
-    bids_subject_id = row['subjectkey'].replace('NDAR_','sub-NDAR')
-    bids_session_id = bids_session_dict[row['eventname']]
+parser = argparse.ArgumentParser(description='Create the subjectkey to BIDS subject and session lookup from the master data file')
+parser.add_argument('--master', default=master_path, help='Master data file to build the lookup from')
+parser.add_argument('--output', default=lookup_path, help='Path of the lookup csv to write')
+parser.add_argument('--store', help='Path of the indexed lookup store to write (default: the --output path with a .sqlite extension, see lookup_store.py)')
+parser.add_argument('--no-store', action='store_true', help='Only write the lookup csv')
+parser.add_argument('--unknown-events', choices=['error', 'skip'], default='error',
+                    help='Raise an error (default) or skip rows whose eventname is not in bids_session_dict')
+args = parser.parse_args()
+
+
+# Build the lookup rows of one chunk of the master data file with vectorized column operations
+def build_lookup_chunk(master_chunk):
+    lookup_chunk = pd.DataFrame({
+        'bids_subject_id': master_chunk['subjectkey'].str.replace('NDAR_', 'sub-NDAR', regex=False),
+        'bids_session_id': master_chunk['eventname'].map(bids_session_dict),
+        'subjectkey': master_chunk['subjectkey'],
+        'src_subject_id': master_chunk['src_subject_id'],
+        'interview_date': master_chunk['interview_date'],
+        'interview_age': master_chunk['interview_age'],
+        'sex': master_chunk['sex']
+    }, columns=lookup_columns)
+
+    # Eventnames missing from bids_session_dict are either an error or explicitly skipped
+    unknown_events = master_chunk['eventname'][lookup_chunk['bids_session_id'].isna()]
+    if len(unknown_events):
+        if args.unknown_events == 'error':
+            raise ValueError(f'eventnames missing from bids_session_dict: {sorted(unknown_events.astype(str).unique())}')
+        lookup_chunk = lookup_chunk[lookup_chunk['bids_session_id'].notna()]
 
-    lookup_df = lookup_df.append({'bids_subject_id': bids_subject_id, 
-                      'bids_session_id': bids_session_id,
-                      'subjectkey': row['subjectkey'],
-                      'src_subject_id': row['src_subject_id'],
-                      'interview_date': row['interview_date'],
-                      'interview_age': row['interview_age'],
-                      'sex': row['sex']}, ignore_index=True)
+    return lookup_chunk, len(unknown_events)
 
-lookup_df.to_csv('main_lookup.csv', index=False, quoting=csv.QUOTE_ALL)
 
+# Stream the master data file in chunks, reading values as text so they are written out exactly as in the master data file,
+#   and append each chunk's lookup rows to the output and the lookup store so the master data file never has to fit in memory at once
+#   The chunks are written to a temporary file next to the output, which only replaces the previous lookup once every chunk succeeded,
+#   and the temporary files of both are removed if any chunk fails
+store_path = args.store or os.path.splitext(args.output)[0] + '.sqlite'
+if not args.no_store:
+    store_con, store_tmp_path = create_store(store_path)
+output_tmp_path = create_temp_file(args.output)
+rows_written = 0
+rows_skipped = 0
+try:
+    master_chunks = pd.read_csv(args.master, usecols=['subjectkey', 'src_subject_id', 'eventname', 'interview_date', 'interview_age', 'sex'],
+                                dtype=str, chunksize=chunksize)
+    for chunk_number, master_chunk in enumerate(master_chunks):
+        lookup_chunk, skipped = build_lookup_chunk(master_chunk)
+        lookup_chunk.to_csv(output_tmp_path, index=False, quoting=csv.QUOTE_ALL, mode='w' if chunk_number == 0 else 'a', header=chunk_number == 0)
+        if not args.no_store:
+            append_rows(store_con, 'lookup', lookup_chunk)
+        rows_written += len(lookup_chunk)
+        rows_skipped += skipped
+except BaseException:
+    os.remove(output_tmp_path)
+    if not args.no_store:
+        store_con.close()
+        os.remove(store_tmp_path)
+    raise
+os.replace(output_tmp_path, args.output)
 
+# Index the lookup store once every row is in, and rename it into place
+if not args.no_store:
+    finish_store(store_con, store_tmp_path, store_path)
+    print(f'Wrote the lookup store {store_path}')
 
+if rows_skipped:
+    print(f'Skipped {rows_skipped} rows with eventnames missing from bids_session_dict')
+print(f'Wrote {rows_written} rows to {args.output}')
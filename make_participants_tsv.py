@@ -1,7 +1,23 @@
 #!/usr/bin/env python3
 
+import argparse
+import json
+import os
 import pandas as pd
 import re
+from concurrent.futures import ThreadPoolExecutor
+from column_encoding import encode_columns
+from duckdb_engine import build_participants_duckdb, duckdb_available
+from incremental import (as_written, changed_entry_specs, changed_keys, changed_values, clear_build_state, key_columns, load_build_state, load_prior_participants,
+                         participants_changelog, projection_digests, source_changed, splice_participants, write_build_state)
+from nda_cache import clear_cache, default_cache_dir, default_cache_max_bytes, evict_cache
+from manifest_index import manifest_subject_sessions
+from nda_io import read_nda_file
+from nda_schema import load_data_dictionary, nda_element_types
+from participants_writers import columnar_formats, partition_columns, write_participants
+from run_report import merge_stage, new_run_report, report_stage, write_run_report
+from source_registry import (bulk_column_specs, bulk_columns, check_read_plan, default_load_workers, load_bulk_spec, load_sources, merge_sources,
+                             plan_source_reads)
 
 pd.set_option('display.max_columns', None)
 pd.set_option('expand_frame_repr', False)
@@ -18,7 +34,7 @@ output_path = '/home/rando149/shared/data/Collection_3165_Supporting_Documentati
 # Data Sources
 
 # Download Tabulated Datasets from NDA
-#   Do not load this entire file into a pandas dataframe, it will take too much memory instead selectively load necessary columns. It is currently being used for handedness information and pc scores
+#   Do not load this entire file into a pandas dataframe, it will take too much memory instead it is streamed in chunks by read_master_data_file, which selectively loads necessary columns and rows. It is currently being used for handedness information and pc scores
 #   The ABCD4.0_MASTER_DATA_FILE is a compilation of data sources. Figure out the actual data sources within the Tabulated BDatasets and Raw Behavioral Data: https://nda.nih.gov/general-query.html?q=query=featured-datasets:Adolescent%20Brain%20Cognitive%20Development%20Study%20(ABCD)
 #   Old source: NeuroCog principal component scores: search for pc1, pc2, and pc3 in https://deap.nimhda.org/applications/Ontology/hierarchy.php?entry=display
 tabulated_data_path = '/home/rando149/shared/data/Collection_3165_Supporting_Documentation/ABCD4.0_MASTER_DATA_FILE.csv'
@@ -40,6 +56,10 @@ mri_info_path = '/home/rando149/shared/data/Collection_3165_Supporting_Documenta
 fastqc01_path = '/home/rando149/shared/data/Collection_3165_Supporting_Documentation/abcd_fastqc01-20211221.txt'
 # Collection 3165 datastructure manifest origin: https://nda.nih.gov/edit_collection.html?id=3165
 c3165_manifest_path = '/home/rando149/shared/data/Collection_3165_Supporting_Documentation/abcd_collection-3165-20230407/datastructure_manifest.txt'
+# Subject and imaging session directories of the associated_file paths in the collection 3165 datastructure manifest
+c3165_associated_file_pattern = re.compile('(sub-NDARINV[A-Z0-9]{8})/(ses-(?:baselineYear1Arm1|2YearFollowUpYArm1|4YearFollowUpYArm1))')
+# Column of the collection 3165 datastructure manifest holding the size in bytes of each associated_file, None if it has none (see manifest_index.py)
+c3165_manifest_size_column = None
 # Download previous participants_v1.0.0 from the collection to pull the matched groups. Original origin: https://github.com/DCAN-Labs/automated-subset-analysis
 #   TODO: Determine more legitimate source for the matched group info (Box directory with the ABCD 2.0 Release)
 original_participants_path = '/home/rando149/shared/data/Collection_3165_Supporting_Documentation/participants_v1.0.0/participants.tsv'
@@ -136,6 +156,92 @@ mri_info_map = {
     "mri_info_softwareversion": "scanner_software"
 }
 
+# Registry of the sources merged onto the fastqc01 subjects and sessions, in merge order (see source_registry.py)
+#   Entries sharing a path are read in a single parse, so adding an instrument from an already used file costs no extra read
+#   Entries with coalesce overwrite the listed columns of earlier entries wherever their values are not NaN
+#   Entries with dedupe are reduced to one row per merge_on key before they are merged, so repeated administrations and
+#   revised submissions do not multiply the participants.tsv rows, entries without dedupe raise an error on duplicate keys
+source_registry = [
+    # Handedness and pc scores from the Tabulated Datasets, streamed keeping only the qc_subjects rows
+    {
+        "name": "tabulated_data",
+        "path": tabulated_data_path,
+        "reader": "master",
+        "column_map": tabulated_data_map,
+        "merge_on": ["participant_id", "session_id"]
+    },
+    # Variable demographic information from the NDA Dictionary's ABCD Longitudinal Parent Demographics Survey
+    {
+        "name": "nda_dict_demo_long",
+        "path": nda_dict_demo_long_path,
+        "reader": "nda",
+        "column_map": nda_dict_demo_long_map,
+        "merge_on": ["participant_id", "session_id"]
+    },
+    # Invariable demographic information from the NDA Dictionary's ABCD Parent Demographics Survey
+    {
+        "name": "nda_dict_demo_invariable",
+        "path": nda_dict_demo_path,
+        "reader": "nda",
+        "column_map": nda_dict_demo_map_invariable,
+        "merge_on": ["participant_id"]
+    },
+    # Baseline demographic information from the NDA Dictionary's ABCD Parent Demographics Survey, overwriting the longitudinal values
+    {
+        "name": "nda_dict_demo_baseline",
+        "path": nda_dict_demo_path,
+        "reader": "nda",
+        "column_map": nda_dict_demo_map_baseline,
+        "merge_on": ["participant_id", "session_id"],
+        "coalesce": ["participant_education", "parental_education_1", "parental_partner_education", "income"]
+    },
+    # Twin information from the NDA Dictionary's ABCD Family History Assessment Part 1
+    {
+        "name": "nda_dict_twin",
+        "path": nda_dict_twin_path,
+        "reader": "nda",
+        "column_map": nda_dict_twin_map,
+        "merge_on": ["participant_id"],
+        # Keep the first answer given when the assessment was administered more than once
+        "dedupe": {"policy": "first"}
+    },
+    # Site information from the NDA Dictionary
+    {
+        "name": "nda_dict_site",
+        "path": nda_dict_site_path,
+        "reader": "nda",
+        "column_map": nda_dict_site_map,
+        "merge_on": ["participant_id", "session_id"]
+    },
+    # Longitudinal anesthesia exposure information from the NDA Dictionary
+    {
+        "name": "nda_dict_anes_long",
+        "path": nda_dict_anes_long_path,
+        "reader": "nda",
+        "column_map": nda_dict_anes_long_map,
+        "merge_on": ["participant_id", "session_id"]
+    },
+    # Baseline anesthesia exposure information from the NDA Dictionary, overwriting the longitudinal values
+    {
+        "name": "nda_dict_anes_base",
+        "path": nda_dict_anes_base_path,
+        "reader": "nda",
+        "column_map": nda_dict_anes_base_map,
+        "merge_on": ["participant_id", "session_id"],
+        "coalesce": ["anesthesia_exposure"]
+    },
+    # MRI scanner information from the NDA Dictionary's ABCD MRI Info
+    {
+        "name": "mri_info",
+        "path": mri_info_path,
+        "reader": "nda",
+        "column_map": mri_info_map,
+        "merge_on": ["participant_id", "session_id"],
+        # Keep the latest submission of revised scanner information
+        "dedupe": {"policy": "latest", "order_by": "interview_date"}
+    }
+]
+
 # DCAN specific variables
 # TODO: Determine origin of matched groups or how to create it as more subjects are added
 # Collection 3165 variable should be derived from subjects that exist on the collection 3165 datastructure manifest
@@ -157,160 +263,7 @@ bids_session_dict = {
     '4_year_follow_up_y_arm_1': 'ses-4YearFollowUpYArm1',
 }
 
-# Load the fastqc01.tsv file into a pandas dataframe, skip the second descriptor row, and rename subjectkey to participant_id and visit to session_id
-qc_df = pd.read_csv(fastqc01_path, delimiter='\t', skiprows=[1])
-# Return a dataframe of all unique subjectkey and visit from the qc_df
-qc_subjects = qc_df[['subjectkey', 'visit']].drop_duplicates() 
-# Rename the subjectkey and visit columns to participant_id and session_id
-qc_subjects = qc_subjects.rename(columns={'subjectkey': 'participant_id', 'visit': 'session_id'})
-
-# Load the tabulated data file into a pandas dataframe using the tabulated_data_map keys as the columns
-tabulated_data_df = pd.read_csv(tabulated_data_path, usecols=tabulated_data_map.keys()).rename(columns=tabulated_data_map)
-# Merge the qc_subjects dataframe with the tabulated_data_df on participant_id and session_id
-participants_df = pd.merge(qc_subjects, tabulated_data_df, how='left', on=['participant_id', 'session_id'])
-
-# Load the variable demographic information from the NDA Dictionary's ABCD Longitudinal Parent Demographics Survey
-nda_dict_demo_long_df = pd.read_csv(nda_dict_demo_long_path, delimiter='\t', skiprows=[1], usecols=nda_dict_demo_long_map.keys()).rename(columns=nda_dict_demo_long_map)
-# Merge the participants_df with the nda_dict_demo_df on participant_id and session_id
-participants_df = pd.merge(participants_df, nda_dict_demo_long_df, how='left', on=['participant_id', 'session_id'])
-
-# Load the invariable demographic information from the NDA Dictionary's ABCD Parent Demographics Survey
-nda_dict_demo_df_invariable = pd.read_csv(nda_dict_demo_path, delimiter='\t', skiprows=[1], usecols=nda_dict_demo_map_invariable.keys()).rename(columns=nda_dict_demo_map_invariable)
-# Merge the participants_df with the nda_dict_demo_df_invariable on participant_id
-participants_df = pd.merge(participants_df, nda_dict_demo_df_invariable, how='left', on=['participant_id'])
-
-# Load the baseline demographic information from the NDA Dictionary's ABCD Parent Demographics Survey
-nda_dict_demo_df_baseline = pd.read_csv(nda_dict_demo_path, delimiter='\t', skiprows=[1], usecols=nda_dict_demo_map_baseline.keys()).rename(columns=nda_dict_demo_map_baseline)
-# Merge the participants_df with the nda_dict_demo_df_baseline on participant_id
-participants_df = pd.merge(participants_df, nda_dict_demo_df_baseline, how='left', on=['participant_id', 'session_id'], suffixes=('', '_new'))
-overwrite_columns = ['participant_education', 'parental_education_1', 'parental_partner_education', 'income']
-# Update the columns with new values from participants_df (columns with '_new' suffix)
-for col in overwrite_columns:
-    mask = ~participants_df[col + '_new'].isnull()  # Only update if new value is not NaN
-    participants_df.loc[mask, col] = participants_df.loc[mask, col + '_new']
-# Drop the columns with '_new' suffix
-participants_df.drop([col + '_new' for col in overwrite_columns], axis=1, inplace=True)
-
-# Load the proper twin information from the NDA Dictionary's ABCD Family History Assessment Part 1
-nda_dict_twin_df = pd.read_csv(nda_dict_twin_path, delimiter='\t', skiprows=[1], usecols=nda_dict_twin_map.keys()).rename(columns=nda_dict_twin_map)
-# Merge the participants_df with the nda_dict_twin_df on participant_id
-participants_df = pd.merge(participants_df, nda_dict_twin_df, how='left', on=['participant_id'])
-
-# Load the proper site information from the NDA Dictionary
-nda_dict_site_df = pd.read_csv(nda_dict_site_path, delimiter='\t', skiprows=[1], usecols=nda_dict_site_map.keys()).rename(columns=nda_dict_site_map)
-# Merge the participants_df with the nda_dict_site_df on participant_id and session_id
-participants_df = pd.merge(participants_df, nda_dict_site_df, how='left', on=['participant_id', 'session_id'])
-
-# Load the proper longitudinal anesthesia exposure infromation from the NDA Dictionary
-nda_dict_anes_long_df = pd.read_csv(nda_dict_anes_long_path, delimiter='\t', skiprows=[1], usecols=nda_dict_anes_long_map.keys()).rename(columns=nda_dict_anes_long_map)
-# Merge the participants_df with the nda_dict_anes_long_df on participant_id and session_id
-participants_df = pd.merge(participants_df, nda_dict_anes_long_df, how='left', on=['participant_id', 'session_id'])
-
-# Load the proper baseline anesthesia exposure information from the NDA Dictionary
-nda_dict_anes_base_df = pd.read_csv(nda_dict_anes_base_path, delimiter='\t', skiprows=[1], usecols=nda_dict_anes_base_map.keys()).rename(columns=nda_dict_anes_base_map)
-# Merge the participants_df with the nda_dict_anes_base_df on participant_id and session_id
-participants_df = pd.merge(participants_df, nda_dict_anes_base_df, how='left', on=['participant_id', 'session_id'], suffixes=('', '_new'))
-# Update the column with new values from participants_df (column with '_new' suffix)
-mask2 = ~participants_df['anesthesia_exposure_new'].isnull() # Only update if new value is not NaN
-participants_df.loc[mask2, 'anesthesia_exposure'] = participants_df.loc[mask2, 'anesthesia_exposure_new']
-# Drop the column with the '_new' suffix
-participants_df.drop(['anesthesia_exposure_new'], axis=1, inplace=True)
-
-# Load the mri_info file into a pandas dataframe using the mri_info_map keys as the columns
-mri_info_df = pd.read_csv(mri_info_path, delimiter='\t', skiprows=[1], usecols=mri_info_map.keys()).rename(columns=mri_info_map)
-# Merge the participants_df with the mri_info_df on participant_id and session_id
-participants_df = pd.merge(participants_df, mri_info_df, how='left', on=['participant_id', 'session_id'])
-
-# Format the participant_id and session_id to BIDS format
-participants_df['participant_id'] = participants_df['participant_id'].apply(lambda x: 'sub-' + x.replace('_',''))
-participants_df['session_id'] = participants_df['session_id'].apply(lambda x: bids_session_dict[x])
-
-# Load collection 3165 datastructure manifest and return df of participant_ids and session_ids
-c3165_manifest_df = pd.read_csv(c3165_manifest_path, delimiter='\t')
-
-# Write a function to extract the subject and session from the associated_file in c3165_manifest_df
-def extract_subject_session(x):
-    if re.search('sub-NDARINV[A-Z0-9]{8}/ses-(baselineYear1Arm1|2YearFollowUpYArm1|4YearFollowUpYArm1)', x):
-        subject, session = re.search('sub-NDARINV[A-Z0-9]{8}/ses-(baselineYear1Arm1|2YearFollowUpYArm1|4YearFollowUpYArm1)', x).group(0).split('/')
-    else:
-        subject, session = None, None
-    return subject, session
-
-c3165_subject_list = c3165_manifest_df['associated_file'].apply(lambda x: extract_subject_session(x)).tolist()
-# Return unique elements of c3165_subject_list
-c3165_subject_list = list(set(c3165_subject_list))
-
-for x in c3165_subject_list:
-    # Set 'collection_3165' to 1 where the participant_id and session_id match x[0] and x[1] in participants_df
-    participants_df.loc[(participants_df['participant_id'] == x[0]) & (participants_df['session_id'] == x[1]), 'collection_3165'] = 1
-
-# Load the matched_groups variable from the original participants.tsv into a pandas dataframe and drop dupilcate participant ids
-matched_groups_df = pd.read_csv(original_participants_path, delimiter='\t', usecols=['participant_id', 'matched_group']) 
-matched_groups_df_unique = matched_groups_df[['participant_id', 'matched_group']].drop_duplicates() 
-participants_df = pd.merge(participants_df, matched_groups_df_unique, how='left', on=['participant_id'])
-
-# Function to properly format each race information column
-def race_column_info(participants_df):
-    column_header_names = (        
-        "White",
-        "Black/African American",
-        "American Indian, Native American",
-        "Alaska Native",
-        "Native Hawaiian",
-        "Guamanian",
-        "Samoan",
-        "Other Pacific Islander",
-        "Asian Indian",
-        "Chinese",
-        "Filipino",
-        "Japanese",
-        "Korean",
-        "Vietnamese",
-        "Other Asian",
-        "Other Race",
-        "Refuse to Answer",
-        "Don't Know",
-        )
-    # Repeat for all race demographic columns 
-    for value in column_header_names:
-        participants_df[value] = participants_df[value].fillna(888)
-        participants_df[value] = participants_df[value].astype('int')
-
-    return
-
-# Convert latinx variable the same way as the other race columns
-participants_df["Do you consider the child Hispanic/Latino/Latina?"] = participants_df["Do you consider the child Hispanic/Latino/Latina?"].fillna(888)
-participants_df["Do you consider the child Hispanic/Latino/Latina?"] = participants_df["Do you consider the child Hispanic/Latino/Latina?"].astype('int')
-
-race_column_info(participants_df)
-
-# Cast handedness as an integer and fill in NaNs with 888
-participants_df["handedness"] = participants_df["handedness"].fillna(888)
-participants_df["handedness"] = participants_df["handedness"].astype('int')
-
-# Cast sibling_twins as an integer and fill in NaNs with 888
-participants_df["siblings_twins"] = participants_df["siblings_twins"].fillna(888)
-participants_df["siblings_twins"] = participants_df["siblings_twins"].astype('int')
-
-# Cast age as an integer and fill in NaNs with 888
-participants_df["age"] = participants_df["age"].fillna(888)
-participants_df["age"] = participants_df["age"].astype('int')
-
-# Cast collection_3165 as an integer and fill in NaNs with 0
-participants_df["collection_3165"] = participants_df["collection_3165"].fillna(0)
-participants_df["collection_3165"] = participants_df["collection_3165"].astype('int')
-
-# Fill site NaNs with integer 888
-participants_df["site"] = participants_df["site"].fillna(888)
-
-# Fill scanner_manufacturer NaNs with integer 888
-participants_df["scanner_manufacturer"] = participants_df["scanner_manufacturer"].fillna(888)
-
-# Fill scanner_model NaNs with integer 888
-participants_df["scanner_model"] = participants_df["scanner_model"].fillna(888)
-
-# Rename scanner_software values to match previous participants.tsv fill NaNs with 888 
-participants_df["scanner_software"] = participants_df["scanner_software"].fillna(888)
+# Hashmap to rename scanner_software values to match previous participants.tsv
 scanner_software_dict = {
     "syngo MR E11": "syngo MR E11",
     "5.3.05.3.0.0": "[5.3.0, 5.3.0.0]",
@@ -329,43 +282,67 @@ scanner_software_dict = {
     "27LXMR Software release:DV26.0_R02_1810.b": "[27, LX, MR Software release:DV26.0_R02_1810.b]",
     "27LXMR Software release:DV26.0_R03_1831.b": "[27, LX, MR Software release:DV26.0_R03_1831.b]",
     "27LXMR Software release:DV26.0_R05_2008.a": "[27, LX, MR Software release:DV26.0_R05_2008.a]",
-    "27Orchestra SDK": "[27, Orchestra SDK]",
-    888: 888
+    "27Orchestra SDK": "[27, Orchestra SDK]"
 }
-participants_df['scanner_software'] = participants_df['scanner_software'].apply(lambda x: scanner_software_dict[x])
-
-# Cast matched_group as an integer and fill in NaNs with 888
-participants_df["matched_group"] = participants_df["matched_group"].fillna(888)
-participants_df["matched_group"] = participants_df["matched_group"].astype('int')
-
-# Cast sex information as an integer and fill in NaNs with 888
-participants_df["sex"] = participants_df["sex"].fillna(888)
-participants_df["sex"] = participants_df["sex"].astype('int')
-
-# Cast income as an integer and fill in NaNs with 888
-participants_df["income"] = participants_df["income"].fillna(888)
-participants_df["income"] = participants_df["income"].astype('int')
-
-# Cast participant_education as an integer and fill in NaNs with 888
-participants_df["participant_education"] = participants_df["participant_education"].fillna(888)
-participants_df["participant_education"] = participants_df["participant_education"].astype('int')
 
-# Calculate max between parental_education_1 and parental_partner_education and save in new parental_education variable, then cast as integer and fill in NaNs with 888
-participants_df["parental_education_1"] = participants_df["parental_education_1"].replace({999.0: -0.1, 777.0: -0.2})
-participants_df["parental_partner_education"] = participants_df["parental_partner_education"].replace({999.0: -0.1, 777.0: -0.2})
-participants_df["parental_education"] = participants_df.apply(lambda row: max(row["parental_education_1"], row["parental_partner_education"]), axis=1)
-participants_df["parental_education"] = participants_df["parental_education"].replace({-0.1: 999.0, -0.2: 777.0})
-participants_df["parental_education"] = participants_df["parental_education"].fillna(888)
-participants_df["parental_education"] = participants_df["parental_education"].astype('int')
+# Columns derived from other participants.tsv columns before the typing pass (see column_encoding.py)
+derived_columns = {
+    # Max between parental_education_1 and parental_partner_education, where 999 (Don't Know) and 777 (Refuse to Answer) rank below every answer
+    "parental_education": {
+        "derive": "coded_max",
+        "columns": ["parental_education_1", "parental_partner_education"],
+        "low_codes": {999.0: -0.1, 777.0: -0.2}
+    }
+}
 
-# Cast anesthesia_exposure as an integer and fill in NaNs with 888
-participants_df["anesthesia_exposure"] = participants_df["anesthesia_exposure"].fillna(888)
-participants_df["anesthesia_exposure"] = participants_df["anesthesia_exposure"].astype('int')
+# Typing pass of the participants.tsv columns (see column_encoding.py)
+#   NaNs are filled with 888, except collection_3165 which is 0 for subjects and sessions missing from the manifest
+column_specs = {
+    "collection_3165": {"fill": 0, "dtype": "int"},
+    "site": {"fill": 888},
+    "scanner_manufacturer": {"fill": 888},
+    "scanner_model": {"fill": 888},
+    # Unmapped scanner_software values raise an error instead of being written out
+    "scanner_software": {"remap": scanner_software_dict, "fill": 888},
+    "matched_group": {"fill": 888, "dtype": "int"},
+    "sex": {"fill": 888, "dtype": "int"},
+    "White": {"fill": 888, "dtype": "int"},
+    "Black/African American": {"fill": 888, "dtype": "int"},
+    "American Indian, Native American": {"fill": 888, "dtype": "int"},
+    "Alaska Native": {"fill": 888, "dtype": "int"},
+    "Native Hawaiian": {"fill": 888, "dtype": "int"},
+    "Guamanian": {"fill": 888, "dtype": "int"},
+    "Samoan": {"fill": 888, "dtype": "int"},
+    "Other Pacific Islander": {"fill": 888, "dtype": "int"},
+    "Asian Indian": {"fill": 888, "dtype": "int"},
+    "Chinese": {"fill": 888, "dtype": "int"},
+    "Filipino": {"fill": 888, "dtype": "int"},
+    "Japanese": {"fill": 888, "dtype": "int"},
+    "Korean": {"fill": 888, "dtype": "int"},
+    "Vietnamese": {"fill": 888, "dtype": "int"},
+    "Other Asian": {"fill": 888, "dtype": "int"},
+    "Other Race": {"fill": 888, "dtype": "int"},
+    "Refuse to Answer": {"fill": 888, "dtype": "int"},
+    "Don't Know": {"fill": 888, "dtype": "int"},
+    "Do you consider the child Hispanic/Latino/Latina?": {"fill": 888, "dtype": "int"},
+    "age": {"fill": 888, "dtype": "int"},
+    "handedness": {"fill": 888, "dtype": "int"},
+    "siblings_twins": {"fill": 888, "dtype": "int"},
+    "income": {"fill": 888, "dtype": "int"},
+    "participant_education": {"fill": 888, "dtype": "int"},
+    "parental_education": {"fill": 888, "dtype": "int"},
+    "anesthesia_exposure": {"fill": 888, "dtype": "int"},
+    "pc1": {"fill": 888},
+    "pc2": {"fill": 888},
+    "pc3": {"fill": 888}
+}
 
-# Fill in pc scores' NaNs with 888
-participants_df["pc1"] = participants_df["pc1"].fillna(888)
-participants_df["pc2"] = participants_df["pc2"].fillna(888)
-participants_df["pc3"] = participants_df["pc3"].fillna(888)
+# Compact nullable dtypes the coded source columns are held in while merging, used wherever the cast is lossless
+merge_dtypes = {
+    **{col: "Int16" for col, spec in column_specs.items() if spec.get("dtype") == "int"},
+    "parental_education_1": "Int16",
+    "parental_partner_education": "Int16"
+}
 
 # Reorder columns to match older versions of participants tsv
 reordered_columns = [
@@ -407,14 +384,241 @@ reordered_columns = [
     "pc1",
     "pc2",
     "pc3"
-    ] 
-participants_df_reordered = participants_df[reordered_columns]
+    ]
+
+
+# Return the participants.tsv columns built from a registry, the reordered_columns followed by its bulk import columns
+def output_columns(registry):
+    return reordered_columns + bulk_columns(registry)
+
 
-# Sort rows A to Z by participant_id
-participants_df_reordered_sorted = participants_df_reordered.sort_values(by='participant_id')
+# Return the column specs of the participants.tsv columns built from a registry, including those of its bulk import columns
+def output_column_specs(registry):
+    return {**column_specs, **bulk_column_specs(registry)}
 
-# Convert participants_df_reordered_sorted to tsv format
-participants_df_reordered_sorted.to_csv(output_path, sep='\t', index=False)
+
+# Load the fastqc01.tsv file, skip the second descriptor row, and return a dataframe of all unique subjectkey and visit renamed to participant_id and session_id
+def load_qc_subjects(path, cache_dir=None):
+    qc_df = read_nda_file(path, ['subjectkey', 'visit'], cache_dir)
+    # Return a dataframe of all unique subjectkey and visit from the qc_df
+    qc_subjects = qc_df[['subjectkey', 'visit']].drop_duplicates()
+    # Rename the subjectkey and visit columns to participant_id and session_id
+    return qc_subjects.rename(columns={'subjectkey': 'participant_id', 'visit': 'session_id'})
+
+
+# Load the matched_groups variable from the original participants.tsv into a pandas dataframe and drop dupilcate participant ids
+def load_matched_groups(path):
+    matched_groups_df = pd.read_csv(path, delimiter='\t', usecols=['participant_id', 'matched_group'])
+    return matched_groups_df[['participant_id', 'matched_group']].drop_duplicates()
+
+
+# Format the participant_id and session_id of a dataframe to BIDS format, returning them as strings
+#   Categorical keys are formatted once per category rather than once per row
+def format_bids_keys(participants_df):
+    participants_df = participants_df.copy()
+    sessions = participants_df['session_id'].astype(object)
+    unknown_sessions = sessions[~sessions.isin(bids_session_dict.keys())].unique()
+    if len(unknown_sessions):
+        raise ValueError(f'session_ids missing from bids_session_dict: {sorted(map(str, unknown_sessions))}')
+    for col, format_key in (('participant_id', lambda x: 'sub-' + x.replace('_', '')), ('session_id', bids_session_dict.get)):
+        if isinstance(participants_df[col].dtype, pd.CategoricalDtype):
+            participants_df[col] = participants_df[col].cat.rename_categories(format_key).astype(object)
+        else:
+            participants_df[col] = participants_df[col].map(format_key)
+    return participants_df
+
+
+# Add the collection_3165 and matched_group columns to a dataframe with BIDS formatted participant_id and session_id
+#   report: optional run report both merges are recorded in as stages
+def add_dcan_columns(participants_df, c3165_subject_sessions, matched_groups_df, report=None):
+    # Set 'collection_3165' to 1 where the participant_id and session_id are in the manifest with a single left merge
+    participants_df = merge_stage(report, 'collection_3165', participants_df, c3165_subject_sessions.assign(collection_3165=1), ['participant_id', 'session_id'])
+    return merge_stage(report, 'matched_group', participants_df, matched_groups_df, ['participant_id'])
+
+
+# Build the participants.tsv rows of qc_subjects from the loaded sources, in qc_subjects order with the output_columns of the registry
+#   report: optional run report every merge and pass is recorded in as a stage
+def build_participants(qc_subjects, source_dfs, c3165_subject_sessions, matched_groups_df, registry=source_registry, report=None):
+    # Merge each registry entry's projection onto the qc_subjects in registry order
+    participants_df = merge_sources(qc_subjects, registry, source_dfs, merge_dtypes, report)
+    with report_stage(report, 'format BIDS keys', rows_in=len(participants_df)) as record:
+        participants_df = format_bids_keys(participants_df)
+        record['rows_out'] = len(participants_df)
+    participants_df = add_dcan_columns(participants_df, c3165_subject_sessions, matched_groups_df, report)
+    # Fill NaNs with the sentinel values, cast the coded columns as integers, rename scanner_software values and derive parental_education in one vectorized pass
+    with report_stage(report, 'encode columns', rows_in=len(participants_df)) as record:
+        participants_df = encode_columns(participants_df, output_column_specs(registry), derived_columns)
+        record['rows_out'] = len(participants_df)
+    return participants_df[output_columns(registry)]
+
+
+# Rebuild only the rows of the prior participants.tsv affected by the changes since the prior build (see incremental.py)
+#   Rows are rebuilt for new fastqc01 subjects and sessions, for keys whose projection of a changed source file differs
+#   from the prior build's digests and for keys whose collection_3165 or matched_group changed. Returns the spliced
+#   participants.tsv rows, the changelog and the projection digests to record for the next build.
+def build_incremental(prior_path, qc_subjects, c3165_subject_sessions, matched_groups_df, cache_dir=None, registry=source_registry, report=None, workers=1):
+    prior_df = load_prior_participants(prior_path, output_columns(registry))
+    state, prior_digests = load_build_state(prior_path)
+    read_plan = plan_source_reads(registry)
+
+    # Registry entries whose spec changed since the prior build (e.g. an edited column_map or coalesce list) can change any row,
+    #   every source file is then treated as changed and every row rebuilt
+    changed_specs = changed_entry_specs(registry, state)
+    if changed_specs:
+        print(f'Registry entries changed since the prior build: {changed_specs}, rebuilding every row')
+
+    # Read the changed source files in full to find the keys whose projections changed
+    changed_paths = [path for path in read_plan if changed_specs or source_changed(path, state['sources'].get(path))]
+    changed_entries = [entry['name'] for entry in registry if entry['path'] in changed_paths]
+    source_dfs = load_sources({path: read_plan[path] for path in changed_paths}, qc_subjects, cache_dir, report, workers)
+    changed_digests = projection_digests(registry, source_dfs, qc_subjects)
+    rebuild_keys = changed_keys(qc_subjects, prior_digests, changed_digests, changed_entries)
+
+    # Add the keys missing from the prior participants.tsv and the keys whose collection_3165 or matched_group changed
+    bids_keys = format_bids_keys(qc_subjects)
+    dcan_columns = ['collection_3165', 'matched_group']
+    dcan_df = encode_columns(add_dcan_columns(bids_keys, c3165_subject_sessions, matched_groups_df), {col: column_specs[col] for col in dcan_columns}, {})
+    prior_index = pd.MultiIndex.from_frame(prior_df[key_columns])
+    new_keys = ~pd.MultiIndex.from_frame(bids_keys).isin(prior_index)
+    dcan_keys = pd.MultiIndex.from_frame(changed_values(prior_df, as_written(dcan_df), dcan_columns))
+    rebuild_mask = qc_subjects.index.isin(rebuild_keys.index) | new_keys | pd.MultiIndex.from_frame(bids_keys).isin(dcan_keys)
+    if changed_specs:
+        rebuild_mask[:] = True
+    rebuild_subjects = qc_subjects[rebuild_mask]
+    print(f'Rebuilding {len(rebuild_subjects)} of {len(qc_subjects)} subjects and sessions, changed sources: {changed_entries}')
+
+    # Read the unchanged source files for the rebuilt keys only and rebuild their rows
+    if len(rebuild_subjects):
+        source_dfs.update(load_sources({path: read for path, read in read_plan.items() if path not in changed_paths}, rebuild_subjects, cache_dir, report, workers))
+        rebuilt_df = as_written(build_participants(rebuild_subjects, source_dfs, c3165_subject_sessions, matched_groups_df, registry, report))
+    else:
+        rebuilt_df = prior_df.iloc[0:0]
+
+    spliced_df = splice_participants(prior_df, rebuilt_df, bids_keys)
+    changelog = participants_changelog(prior_df, spliced_df, rebuilt_df)
+
+    # Keep the prior digests of the unchanged entries for the keys that were not rebuilt
+    unchanged_digests = prior_digests[~prior_digests['entry'].isin(changed_entries)]
+    rebuilt_index = pd.MultiIndex.from_frame(rebuild_subjects[key_columns])
+    unchanged_digests = unchanged_digests[~(pd.MultiIndex.from_frame(unchanged_digests[key_columns]).isin(rebuilt_index)
+                                            | ((unchanged_digests['session_id'] == '') & unchanged_digests['participant_id'].isin(rebuild_subjects['participant_id'])))]
+    rebuilt_digests = projection_digests([entry for entry in registry if entry['name'] not in changed_entries], source_dfs, rebuild_subjects)
+    digests_df = pd.concat([unchanged_digests, rebuilt_digests, changed_digests], ignore_index=True)
+    digests_df = digests_df.drop_duplicates(['entry', *key_columns], keep='last')
+
+    return spliced_df, changelog, digests_df
+
+
+# Run a load function as a stage of the run report, recording the rows of the dataframe it returns
+def load_stage(report, name, function, *args):
+    with report_stage(report, name) as record:
+        loaded_df = function(*args)
+        record['rows_out'] = len(loaded_df)
+    return loaded_df
+
+
+if __name__ == '__main__':
+    # Parsed NDA source files are cached as Parquet in cache_dir so reruns do not re-parse the text files
+    #   Use --no-cache to bypass the cache, --clear-cache to empty it and --cache-max-gb to limit its size
+    parser = argparse.ArgumentParser(description='Create the Collection 3165 participants.tsv from the NDA source files')
+    parser.add_argument('--no-cache', action='store_true', help='Parse every source text file instead of using the Parquet cache')
+    parser.add_argument('--cache-dir', default=default_cache_dir, help=f'Directory of the parsed source cache (default: {default_cache_dir})')
+    parser.add_argument('--cache-max-gb', type=float, default=default_cache_max_bytes / 1024 ** 3, help='Evict least recently used cache entries past this size')
+    parser.add_argument('--clear-cache', action='store_true', help='Remove every cached source before the build')
+    parser.add_argument('--incremental', metavar='PRIOR_TSV',
+                        help='Only rebuild the rows of this prior participants.tsv affected by changes since its build, writing a changelog next to the output')
+    parser.add_argument('--report', metavar='REPORT_JSON',
+                        help='Write a json run report with the elapsed time, RSS change, rows in and out and merge key cardinality of every stage')
+    parser.add_argument('--abort-on-fanout', action='store_true', help='Stop the build when a merge adds rows through duplicate keys in a source')
+    parser.add_argument('--workers', type=int, default=default_load_workers, help=f'Number of source files parsed at once (default: {default_load_workers})')
+    parser.add_argument('--engine', choices=['pandas', 'duckdb'], default='pandas',
+                        help='Build with pandas, or with DuckDB scanning the source files lazily within a memory limit (see duckdb_engine.py)')
+    parser.add_argument('--memory-limit', help="Memory limit of the duckdb engine, e.g. '8GB', past which it spills to disk")
+    parser.add_argument('--output-formats', nargs='+', choices=list(columnar_formats), default=[],
+                        help='Also write participants.tsv in these typed columnar formats next to it (see participants_writers.py)')
+    parser.add_argument('--partition-by', nargs='+', choices=partition_columns, default=[],
+                        help='Also write each --output-formats copy partitioned into a directory per value of these columns')
+    parser.add_argument('--bulk-spec', metavar='SPEC_JSON',
+                        help='Also import the columns of the NDA instruments listed in this json spec, appended after the other columns (see load_bulk_spec in source_registry.py)')
+    parser.add_argument('--data-dictionary', nargs='+', default=[], metavar='DICTIONARY_CSV',
+                        help='NDA data dictionary csv files whose element DataTypes extend or override the typed NDA schema (see nda_schema.py)')
+    parser.add_argument('--no-lookup-store', action='store_true', help='Do not write the indexed lookup store next to participants.tsv (see lookup_store.py)')
+    args = parser.parse_args()
+    if args.engine == 'duckdb' and not duckdb_available:
+        parser.error('--engine duckdb needs the duckdb package')
+    if args.engine == 'duckdb' and args.incremental:
+        parser.error('--incremental is only supported by the pandas engine')
+    if args.clear_cache:
+        clear_cache(args.cache_dir)
+    cache_dir = None if args.no_cache else args.cache_dir
+    report = new_run_report(args.abort_on_fanout)
+    # NDA files are parsed with the dtypes of their elements' DataTypes, the data dictionaries overriding the built-in ones
+    for dictionary_path in args.data_dictionary:
+        nda_element_types.update(load_data_dictionary(dictionary_path))
+
+    # Bulk import entries are merged after the source_registry entries, into columns none of them build
+    registry = source_registry
+    if args.bulk_spec:
+        registry_columns = {*reordered_columns, *derived_columns, *(name for entry in source_registry for name in entry['column_map'].values())}
+        registry = source_registry + load_bulk_spec(args.bulk_spec, registry_columns)
+
+    # Check the headers of fastqc01 and of every registry source before any of them is parsed, so a renamed column fails the build
+    #   up front instead of after the master data file has been streamed
+    read_plan = plan_source_reads(registry)
+    check_read_plan({fastqc01_path: {'reader': 'nda', 'columns': ['subjectkey', 'visit']}, **read_plan})
+
+    try:
+        if args.engine == 'duckdb':
+            # DuckDB reads the source text files itself, so the Parquet cache and the projection digests are not used
+            participants_df = build_participants_duckdb(registry, fastqc01_path, c3165_manifest_path, c3165_associated_file_pattern,
+                                                        original_participants_path, bids_session_dict, output_column_specs(registry), derived_columns,
+                                                        output_columns(registry), args.workers, args.memory_limit, report)
+            # Sort rows A to Z by participant_id
+            participants_df_sorted = participants_df.sort_values(by='participant_id')
+            digests_df = None
+        else:
+            qc_subjects = load_stage(report, 'load fastqc01', load_qc_subjects, fastqc01_path, cache_dir)
+            # The manifest and matched groups do not depend on the other sources, read them in the background while the sources load
+            dcan_executor = ThreadPoolExecutor(max_workers=2)
+            # Load the unique participant_ids and session_ids in the associated_file paths of the collection 3165 datastructure manifest
+            #   from its memory-mapped index in cache_dir, which is only rebuilt when the manifest changes
+            c3165_future = dcan_executor.submit(load_stage, report, 'load 3165 manifest', manifest_subject_sessions, c3165_manifest_path,
+                                                c3165_associated_file_pattern, cache_dir, c3165_manifest_size_column)
+            matched_groups_future = dcan_executor.submit(load_stage, report, 'load matched groups', load_matched_groups, original_participants_path)
+            dcan_executor.shutdown(wait=False)
+
+            if args.incremental:
+                c3165_subject_sessions, matched_groups_df = c3165_future.result(), matched_groups_future.result()
+                participants_df_sorted, changelog, digests_df = build_incremental(args.incremental, qc_subjects, c3165_subject_sessions, matched_groups_df, cache_dir, registry, report, args.workers)
+                changelog_path = os.path.splitext(output_path)[0] + '_changelog.json'
+                with open(changelog_path, 'w') as f:
+                    json.dump({'prior': args.incremental, **changelog}, f, indent=2)
+                print(f"{len(changelog['added'])} rows added, {len(changelog['changed'])} changed and {len(changelog['removed'])} removed, see {changelog_path}")
+            else:
+                # Read every source file in the registry once
+                source_dfs = load_sources(read_plan, qc_subjects, cache_dir, report, args.workers)
+                c3165_subject_sessions, matched_groups_df = c3165_future.result(), matched_groups_future.result()
+                participants_df = build_participants(qc_subjects, source_dfs, c3165_subject_sessions, matched_groups_df, registry, report)
+                # Sort rows A to Z by participant_id
+                participants_df_sorted = participants_df.sort_values(by='participant_id')
+                digests_df = projection_digests(registry, source_dfs, qc_subjects)
+
+        # Keep the source cache within its size limit now that every source file has been read
+        if cache_dir is not None:
+            evict_cache(cache_dir, args.cache_max_gb * 1024 ** 3)
+
+        # Write participants_df_sorted as tsv and its columnar copies, and record the build state for the next incremental build
+        with report_stage(report, 'write participants.tsv', rows_in=len(participants_df_sorted)) as record:
+            record['outputs'] = write_participants(participants_df_sorted, output_path, args.output_formats, args.partition_by,
+                                                   not args.no_lookup_store, args.workers)
+            if digests_df is None:
+                clear_build_state(output_path)
+            else:
+                write_build_state(output_path, registry, digests_df)
+    finally:
+        # Write the run report even when a stage failed, the failed stage records the error
+        if args.report:
+            write_run_report(report, args.report)
 
 #FUTURE NOTES:
 #
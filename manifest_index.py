@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import json
+import os
+import sys
+import numpy as np
+import pandas as pd
+from atomic_files import write_file_atomic, write_text_atomic
+from incremental import source_changed, source_fingerprint
+from nda_cache import cache_entry_paths, default_cache_dir
+from nda_io import master_chunksize, read_manifest_subject_sessions
+
+# Memory-mapped index of a datastructure manifest
+#   The manifest is scanned once and the subject and session of every associated_file path reduced to one row per
+#   (participant_id, session_id) with its file count and total file size. The rows are stored sorted as a numpy structured
+#   array in the cache directory, next to a json sidecar with the manifest's fingerprint and the options it was built with,
+#   and memory mapped on load, so membership and per-session file stats are read without scanning the manifest again.
+#   The index is only rebuilt when the manifest changes.
+#     python manifest_index.py sub-NDARINV00000000 --session ses-baselineYear1Arm1
+
+# Value of total_size in indexes of manifests without a file size column
+unknown_size = -1
+
+
+# Return the paths of the index and its json sidecar for the manifest at path in cache_dir
+def index_paths(cache_dir, path):
+    base_path = cache_entry_paths(cache_dir, path)[0][:-len('.parquet')] + '.manifest_index'
+    return base_path + '.npy', base_path + '.json'
+
+
+# Scan the manifest at path in chunks, returning the sorted structured array of (participant_id, session_id, file_count, total_size)
+#   pattern: compiled regular expression with two groups, the BIDS subject and the BIDS session of an associated_file path
+#   size_column: optional manifest column holding the size in bytes of each associated_file, total_size is unknown_size without it
+def build_manifest_index(path, pattern, size_column=None, chunksize=master_chunksize):
+    columns = ['associated_file'] + ([size_column] if size_column is not None else [])
+    chunk_stats = []
+    for chunk in pd.read_csv(path, delimiter='\t', usecols=columns, chunksize=chunksize):
+        # Vectorized extraction of the first subject/session match of every path, dropping paths without one
+        files_df = chunk['associated_file'].str.extract(pattern)
+        files_df.columns = ['participant_id', 'session_id']
+        files_df['total_size'] = pd.to_numeric(chunk[size_column], errors='coerce').fillna(0).astype('int64') if size_column is not None else 0
+        files_df = files_df.dropna(subset=['participant_id', 'session_id'])
+        chunk_stats.append(files_df.groupby(['participant_id', 'session_id']).agg(file_count=('total_size', 'size'), total_size=('total_size', 'sum')))
+
+    stats_df = pd.concat(chunk_stats).groupby(level=[0, 1]).sum().reset_index()
+    if size_column is None:
+        stats_df['total_size'] = unknown_size
+    widths = {col: max(1, int(stats_df[col].str.len().max())) if len(stats_df) else 1 for col in ['participant_id', 'session_id']}
+    index = np.empty(len(stats_df), dtype=[('participant_id', f"S{widths['participant_id']}"), ('session_id', f"S{widths['session_id']}"),
+                                           ('file_count', 'i8'), ('total_size', 'i8')])
+    for col in index.dtype.names:
+        index[col] = stats_df[col].to_numpy(dtype=index.dtype[col])
+    return index
+
+
+# Write the index to path as a .npy file, whatever the extension of path
+def write_index(path, index):
+    with open(path, 'wb') as f:
+        np.save(f, index)
+
+
+# Return the memory-mapped index of the manifest at path, building it in cache_dir first if it is missing or out of date
+#   rebuild: build the index even if an up to date one exists
+def load_manifest_index(path, pattern, cache_dir, size_column=None, rebuild=False):
+    index_path, meta_path = index_paths(cache_dir, path)
+    options = {'path': os.path.abspath(path), 'pattern': pattern.pattern, 'size_column': size_column}
+    meta = None
+    if os.path.exists(index_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    if not rebuild and meta is not None and meta['options'] == options and not source_changed(path, meta['fingerprint']):
+        # Mark the index as recently used for eviction (see nda_cache.evict_cache)
+        os.utime(index_path)
+        return np.load(index_path, mmap_mode='r')
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fingerprint = source_fingerprint(path)
+    index = build_manifest_index(path, pattern, size_column)
+    write_file_atomic(index_path, lambda tmp_path: write_index(tmp_path, index))
+    write_text_atomic(meta_path, json.dumps({'options': options, 'fingerprint': fingerprint, 'rows': len(index)}, indent=2))
+    print(f'Indexed {int(index["file_count"].sum())} files of {len(index)} subjects and sessions from {path}')
+    return np.load(index_path, mmap_mode='r')
+
+
+# Return the rows of the index for participant_id, of all its sessions or only of session_id, as hashmaps
+#   The index is sorted by participant_id, so the subject's rows are found by binary search
+def query_manifest_index(index, participant_id, session_id=None):
+    key = participant_id.encode()
+    start = np.searchsorted(index['participant_id'], key, side='left')
+    stop = np.searchsorted(index['participant_id'], key, side='right')
+    rows = []
+    for row in index[start:stop]:
+        if session_id is None or row['session_id'] == session_id.encode():
+            rows.append({'participant_id': participant_id, 'session_id': row['session_id'].decode(),
+                         'file_count': int(row['file_count']), 'total_size': int(row['total_size'])})
+    return rows
+
+
+# Return a dataframe of the unique (participant_id, session_id) pairs of the manifest at path, from its index in cache_dir
+#   Without a cache_dir the manifest is scanned directly (see nda_io.read_manifest_subject_sessions)
+def manifest_subject_sessions(path, pattern, cache_dir=None, size_column=None):
+    if cache_dir is None:
+        return read_manifest_subject_sessions(path, pattern)
+    index = load_manifest_index(path, pattern, cache_dir, size_column)
+    return pd.DataFrame({col: index[col].astype(str).astype(object) for col in ['participant_id', 'session_id']})
+
+
+if __name__ == '__main__':
+    import make_participants_tsv as mpt
+    parser = argparse.ArgumentParser(description='Build and query the memory-mapped index of the collection 3165 datastructure manifest')
+    parser.add_argument('participant_ids', nargs='*', help='BIDS subjects to print the manifest file stats of')
+    parser.add_argument('--session', help='Only print the stats of this BIDS session')
+    parser.add_argument('--manifest', default=mpt.c3165_manifest_path, help='Datastructure manifest to index')
+    parser.add_argument('--size-column', default=mpt.c3165_manifest_size_column, help='Manifest column holding the size in bytes of each associated_file')
+    parser.add_argument('--cache-dir', default=default_cache_dir, help=f'Directory the index is kept in (default: {default_cache_dir})')
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild the index even if the manifest has not changed')
+    parser.add_argument('--json', action='store_true', help='Print the rows as json instead of tab separated values')
+    args = parser.parse_args()
+
+    index = load_manifest_index(args.manifest, mpt.c3165_associated_file_pattern, args.cache_dir, args.size_column, args.rebuild)
+    if not args.participant_ids:
+        print(f"{len(np.unique(index['participant_id']))} subjects, {len(index)} subjects and sessions, {int(index['file_count'].sum())} files")
+        sys.exit()
+
+    rows = [row for participant_id in args.participant_ids for row in query_manifest_index(index, participant_id, args.session)]
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    elif rows:
+        writer = csv.DictWriter(sys.stdout, fieldnames=list(rows[0]), delimiter='\t', lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+    if not rows:
+        sys.exit(f'No manifest files found for {args.participant_ids}')
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import hashlib
+import importlib.util
+import json
+import os
+import pandas as pd
+from atomic_files import create_temp_file, write_text_atomic
+
+# On-disk cache of parsed NDA source files
+#   Each source file is parsed once in full and stored as Parquet in the cache directory, next to a json
+#   sidecar recording the source path, size, mtime, content hash and read options it was parsed with.
+#   Projections are then read from the Parquet file, so editing a mapping dict only loads the new columns.
+#   An entry is invalidated when the source size or content hash changes, and least recently used entries
+#   are evicted once the cache grows past its size limit.
+default_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'abcc-participants')
+default_cache_max_bytes = 20 * 1024 ** 3
+
+# Parquet support comes from pyarrow, without it every read falls back to parsing the text file
+parquet_available = importlib.util.find_spec('pyarrow') is not None
+
+
+# Return the sha256 hex digest of the contents of the file at path
+def file_sha256(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Return the paths of the Parquet data file and the json sidecar used to cache the source file at path
+def cache_entry_paths(cache_dir, path):
+    source_id = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()[:24]
+    return os.path.join(cache_dir, source_id + '.parquet'), os.path.join(cache_dir, source_id + '.json')
+
+
+# Return the cache metadata for path if a valid entry exists for the current file contents and read options, otherwise None
+def lookup_cache_entry(cache_dir, path, read_options):
+    data_path, meta_path = cache_entry_paths(cache_dir, path)
+    if not (os.path.exists(data_path) and os.path.exists(meta_path)):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    stat = os.stat(path)
+    if meta['path'] != os.path.abspath(path) or meta['read_options'] != read_options or meta['size'] != stat.st_size:
+        return None
+    if meta['mtime_ns'] != stat.st_mtime_ns:
+        # The file was touched, only reuse the entry if the contents are unchanged
+        if meta['sha256'] != file_sha256(path):
+            return None
+        meta['mtime_ns'] = stat.st_mtime_ns
+        write_text_atomic(meta_path, json.dumps(meta, indent=2))
+
+    # Mark the entry as recently used for eviction
+    os.utime(data_path)
+    return meta
+
+
+# Parse the full source file and store it in the cache, returning the parsed dataframe
+def fill_cache_entry(cache_dir, path, read_options):
+    data_path, meta_path = cache_entry_paths(cache_dir, path)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    stat = os.stat(path)
+    sha256 = file_sha256(path)
+    source_df = pd.read_csv(path, low_memory=False, **read_options)
+
+    tmp_path = create_temp_file(data_path)
+    try:
+        source_df.to_parquet(tmp_path, index=False)
+    except (ValueError, TypeError) as e:
+        # Columns pyarrow can not store are left uncached, the caller still gets the parsed dataframe
+        os.remove(tmp_path)
+        print(f'Not caching {path}: {e}')
+        return source_df
+    os.replace(tmp_path, data_path)
+
+    meta = {
+        'path': os.path.abspath(path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': sha256,
+        'read_options': read_options,
+        'columns': list(source_df.columns)
+    }
+    write_text_atomic(meta_path, json.dumps(meta, indent=2))
+
+    return source_df
+
+
+# Remove least recently used cache entries until the cache is no larger than max_bytes
+#   Entries are the Parquet files and the manifest indexes (see manifest_index.py), each removed with its json sidecar
+def evict_cache(cache_dir, max_bytes):
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(('.parquet', '.npy')):
+            data_path = os.path.join(cache_dir, name)
+            stat = os.stat(data_path)
+            entries.append((stat.st_mtime, stat.st_size, data_path))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, data_path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        os.remove(data_path)
+        meta_path = os.path.splitext(data_path)[0] + '.json'
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        total_bytes -= size
+
+
+# Remove every entry from the cache
+def clear_cache(cache_dir):
+    if not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        if name.endswith(('.parquet', '.npy', '.json', '.tmp')):
+            os.remove(os.path.join(cache_dir, name))
+
+
+# Read the columns of a delimited source file through the cache, falling back to parsing the text file when
+#   cache_dir is None (the --no-cache bypass) or Parquet support is not installed
+#   read_options: keyword arguments for pd.read_csv, part of the cache key (e.g. delimiter and skiprows)
+def read_cached_csv(path, columns, cache_dir=None, **read_options):
+    if cache_dir is None or not parquet_available:
+        return pd.read_csv(path, usecols=columns, **read_options)
+
+    meta = lookup_cache_entry(cache_dir, path, read_options)
+    if meta is None:
+        source_df = fill_cache_entry(cache_dir, path, read_options)
+        source_columns = list(source_df.columns)
+    else:
+        source_df = None
+        source_columns = meta['columns']
+
+    missing_columns = [col for col in columns if col not in source_columns]
+    if missing_columns:
+        raise ValueError(f'Columns {missing_columns} not found in {path}')
+    # Keep the columns in file order, matching pd.read_csv with usecols
+    projected_columns = [col for col in source_columns if col in columns]
+
+    if source_df is not None:
+        return source_df[projected_columns]
+    return pd.read_parquet(cache_entry_paths(cache_dir, path)[0], columns=projected_columns)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import os
+import pandas as pd
+from nda_cache import read_cached_csv
+from nda_schema import check_columns, read_header, read_nda_header, schema_dtypes
+
+# Number of rows of the master data file held in memory at once while streaming it
+master_chunksize = 50000
+
+
+# Stream the tabulated master data file in chunks, keeping only the given columns and only the rows whose
+#   key columns are present in key_df. Peak memory is bounded by the chunk size plus the kept rows,
+#   regardless of how large the master data file is.
+#   columns: master data file columns to load, including the key columns
+#   key_df: dataframe of the keys to keep, using the participants.tsv column names (e.g. qc_subjects)
+#   key_columns: hashmap of master data file key column name to the key_df column name (e.g. subjectkey to participant_id)
+def read_master_data_file(path, columns, key_df, key_columns, chunksize=master_chunksize):
+    check_columns(path, read_header(path, ','), columns)
+    key_index = pd.MultiIndex.from_frame(key_df[list(key_columns.values())].drop_duplicates())
+
+    kept_chunks = []
+    rows_scanned = 0
+    with open(path, 'rb') as f:
+        for chunk in pd.read_csv(f, usecols=columns, chunksize=chunksize):
+            rows_scanned += len(chunk)
+            # Drop rows that will not survive the left merge onto key_df
+            chunk_index = pd.MultiIndex.from_frame(chunk[list(key_columns)])
+            kept_chunks.append(chunk[chunk_index.isin(key_index)])
+        bytes_scanned = f.tell()
+
+    if kept_chunks:
+        master_df = pd.concat(kept_chunks, ignore_index=True)
+    else:
+        master_df = pd.DataFrame(columns=list(columns))
+
+    print(f'Scanned {bytes_scanned} of {os.path.getsize(path)} bytes from {path}: kept {len(master_df)} of {rows_scanned} rows')
+
+    return master_df
+
+
+# Read the columns of an NDA Dictionary tab-delimited file with the typed schema of its header (see nda_schema.py)
+#   The header and descriptor rows are read first, so missing columns raise an error before any data is parsed
+#   The file is parsed through the source cache in cache_dir, pass cache_dir=None to parse the text file directly
+def read_nda_file(path, columns, cache_dir=None):
+    header, _ = read_nda_header(path)
+    check_columns(path, header, columns)
+    return read_cached_csv(path, columns, cache_dir, delimiter='\t', header=None, names=header, skiprows=2, dtype=schema_dtypes(header))
+
+
+# Return a dataframe of the unique (participant_id, session_id) pairs found in the associated_file column of a datastructure manifest
+#   pattern: compiled regular expression with two groups, the BIDS subject and the BIDS session of an associated_file path
+#   The manifest is scanned in chunks so multi-million row manifests never have to fit in memory at once, cached scans are
+#   kept by manifest_index.py
+def read_manifest_subject_sessions(path, pattern, chunksize=master_chunksize):
+    chunks = pd.read_csv(path, delimiter='\t', usecols=['associated_file'], chunksize=chunksize)
+
+    subject_sessions = []
+    for chunk in chunks:
+        # Vectorized extraction of the first subject/session match of every path, dropping paths without one
+        extracted = chunk['associated_file'].str.extract(pattern).dropna()
+        subject_sessions.append(extracted.drop_duplicates())
+
+    subject_sessions_df = pd.concat(subject_sessions, ignore_index=True).drop_duplicates(ignore_index=True)
+    subject_sessions_df.columns = ['participant_id', 'session_id']
+    return subject_sessions_df
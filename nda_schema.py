@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import csv
+import difflib
+import pandas as pd
+
+# Typed schema of the NDA Dictionary tab-delimited files
+#   Every NDA file starts with a header row of element names and a descriptor row describing each element. Both rows are
+#   read once before any data is parsed, so columns missing from a file (e.g. a renamed site_id_l) are reported with their
+#   closest matches up front, and the data rows are parsed straight into the dtypes of the elements' NDA DataTypes instead
+#   of inferred ones, so coded columns are neither upcast to float64 by their missing values nor read as mixed objects.
+#   Element types come from nda_element_types, extended or overridden by NDA data dictionaries (see load_data_dictionary).
+#   Elements without a type are left to pandas' inference.
+
+# Hashmap of NDA DataType to the dtype its elements are parsed as, integers as nullable integers so missing values keep them integers
+nda_data_types = {
+    'GUID': 'str',
+    'String': 'str',
+    'Date': 'str',
+    'Integer': 'Int64',
+    'Float': 'float64'
+}
+
+# Hashmap of NDA element name to its NDA DataType, for the elements make_participants_tsv.py reads
+nda_element_types = {
+    'subjectkey': 'GUID',
+    'src_subject_id': 'String',
+    'eventname': 'String',
+    'visit': 'String',
+    'interview_date': 'Date',
+    'interview_age': 'Integer',
+    'sex': 'String',
+    'demo_sex_v2': 'Integer',
+    **{f'demo_race_a_p___{code}': 'Integer' for code in [*range(10, 26), 77, 99]},
+    'demo_ethn_v2': 'Integer',
+    'demo_comb_income_v2': 'Integer',
+    'demo_prnt_ed_v2': 'Integer',
+    'demo_prtnr_ed_v2': 'Integer',
+    'demo_ed_v2': 'Integer',
+    'demo_comb_income_v2_l': 'Integer',
+    'demo_prnt_ed_v2_l': 'Integer',
+    'demo_prtnr_ed_v2_l': 'Integer',
+    'demo_ed_v2_l': 'Integer',
+    'fhx_3c_sibs_same_birth': 'Integer',
+    'site_id_l': 'String',
+    'medhx_ss_9b_p': 'Integer',
+    'medhx_ss_9b_p_l': 'Integer',
+    'mri_info_manufacturer': 'String',
+    'mri_info_manufacturersmn': 'String',
+    'mri_info_softwareversion': 'String'
+}
+
+
+# Return the column names of the header row of a delimited text file, numbering repeated names .1, .2 like pandas.read_csv
+def read_header(path, delimiter):
+    with open(path, newline='') as f:
+        names = next(csv.reader(f, delimiter=delimiter), [])
+    counts = {}
+    header = []
+    for name in names:
+        header.append(name if name not in counts else f'{name}.{counts[name]}')
+        counts[name] = counts.get(name, 0) + 1
+    return header
+
+
+# Return the element names of the header row and the descriptions of the descriptor row of an NDA file
+def read_nda_header(path):
+    with open(path, newline='') as f:
+        rows = csv.reader(f, delimiter='\t')
+        next(rows, None)
+        descriptions = next(rows, [])
+    return read_header(path, '\t'), descriptions
+
+
+# Raise a ValueError listing the columns missing from the header of the file at path, with the closest header columns to each
+def check_columns(path, header, columns):
+    missing_columns = [col for col in columns if col not in header]
+    if missing_columns:
+        suggestions = {col: difflib.get_close_matches(col, header, n=3) for col in missing_columns}
+        hints = ', '.join(f'{col} (did you mean {" or ".join(matches)}?)' if matches else col for col, matches in suggestions.items())
+        raise ValueError(f'Columns not found in {path}: {hints}')
+
+
+# Return the hashmap of the NDA element name to NDA DataType of an NDA data dictionary csv (its ElementName and DataType columns)
+def load_data_dictionary(path):
+    dictionary_df = pd.read_csv(path, usecols=['ElementName', 'DataType'], dtype=str).dropna()
+    unknown_types = sorted(set(dictionary_df['DataType']) - set(nda_data_types))
+    if unknown_types:
+        raise ValueError(f'{path} has DataTypes {unknown_types}, expected one of {list(nda_data_types)}')
+    return dict(zip(dictionary_df['ElementName'], dictionary_df['DataType']))
+
+
+# Return the hashmap of column to dtype of the typed columns of an NDA file header
+def schema_dtypes(header):
+    return {col: nda_data_types[nda_element_types[col]] for col in header if col in nda_element_types}
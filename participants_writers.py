@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import os
+from atomic_files import write_dir_atomic, write_file_atomic
+from lookup_store import write_store
+from nda_cache import parquet_available
+from worker_pool import run_calls
+
+# Writers of participants.tsv and its typed columnar copies
+#   Every output is written to a temporary file or directory next to it and renamed into place (see atomic_files.py), so readers
+#   never see a partially written output. The columnar formats keep the column types (coded columns stay integers and the pc scores
+#   floats), so downstream consumers read them without parsing text:
+#     parquet: compressed Parquet
+#     arrow: uncompressed Arrow IPC (Feather v2), which pyarrow can memory map and read without copying
+#   Columnar outputs can also be partitioned by a column into hive style directories (e.g. site=site01/).
+#   The indexed SQLite lookup store of lookup_store.py is written alongside them.
+
+# Hashmap of columnar output format to the file extension of its output and its pyarrow dataset format
+columnar_formats = {
+    'parquet': {'extension': '.parquet', 'dataset_format': 'parquet'},
+    'arrow': {'extension': '.arrow', 'dataset_format': 'ipc'}
+}
+
+# Columns participants.tsv can be partitioned by
+partition_columns = ['site', 'session_id']
+
+
+# Return the path of a columnar output next to participants_path, e.g. participants.parquet or participants_by_site.parquet
+def columnar_output_path(participants_path, output_format, partition_by=None):
+    base_path = os.path.splitext(participants_path)[0]
+    suffix = f'_by_{partition_by}' if partition_by is not None else ''
+    return base_path + suffix + columnar_formats[output_format]['extension']
+
+
+# Return participants_df as a pyarrow table, with object columns holding sentinel integers among strings (e.g. 888 sites) stored as strings
+def participants_table(participants_df):
+    import pyarrow as pa
+    participants_df = participants_df.reset_index(drop=True)
+    for col in participants_df.columns:
+        if participants_df[col].dtype == object:
+            participants_df[col] = participants_df[col].where(participants_df[col].isna(), participants_df[col].astype(str))
+    return pa.Table.from_pandas(participants_df, preserve_index=False)
+
+
+# Write participants_df as participants.tsv, the format every earlier version of make_participants_tsv.py wrote
+def write_tsv(participants_df, path):
+    write_file_atomic(path, lambda tmp_path: participants_df.to_csv(tmp_path, sep='\t', index=False))
+
+
+# Write participants_df in a columnar format, partitioned into one file per value of partition_by if it is given
+def write_columnar(participants_df, path, output_format, partition_by=None):
+    import pyarrow.dataset as ds
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+    table = participants_table(participants_df)
+    if partition_by is not None:
+        write_dir_atomic(path, lambda tmp_dir: ds.write_dataset(table, tmp_dir, format=columnar_formats[output_format]['dataset_format'],
+                                                                partitioning=[partition_by], partitioning_flavor='hive',
+                                                                existing_data_behavior='overwrite_or_ignore'))
+    elif output_format == 'parquet':
+        write_file_atomic(path, lambda tmp_path: pq.write_table(table, tmp_path))
+    else:
+        write_file_atomic(path, lambda tmp_path: feather.write_feather(table, tmp_path, compression='uncompressed'))
+
+
+# Return the path of the lookup store written next to participants_path, e.g. participants.sqlite
+def lookup_store_path(participants_path):
+    return os.path.splitext(participants_path)[0] + '.sqlite'
+
+
+# Write participants.tsv, its columnar copies and its lookup store in parallel, returning the paths written
+#   output_formats: columnar formats written next to participants_path (see columnar_formats)
+#   partition_by: columns each columnar format is also written partitioned by (see partition_columns)
+#   lookup_store: also write the indexed lookup store of lookup_store.py
+#   Every output is attempted, the failed ones are raised together afterwards (see worker_pool.py)
+def write_participants(participants_df, participants_path, output_formats=[], partition_by=[], lookup_store=False, workers=1):
+    if output_formats and not parquet_available:
+        raise ValueError(f'Writing {output_formats} needs the pyarrow package')
+    writes = {participants_path: (write_tsv, participants_df, participants_path)}
+    if lookup_store:
+        writes[lookup_store_path(participants_path)] = (write_store, lookup_store_path(participants_path), 'participants', participants_df)
+    for output_format in output_formats:
+        for partition_column in [None, *partition_by]:
+            path = columnar_output_path(participants_path, output_format, partition_column)
+            writes[path] = (write_columnar, participants_df, path, output_format, partition_column)
+
+    return list(run_calls(writes, workers, 'write', 'outputs'))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+import pandas as pd
+
+# Run report of a make_participants_tsv.py build
+#   A report is a hashmap holding the list of instrumented stages, each stage recording its elapsed time, the change in
+#   RSS while it ran and its rows in and out. Merge stages also record the key cardinality of the merged source and
+#   the rows the merge added through duplicate keys (fan-out), optionally aborting the build when that happens.
+
+
+# Return the current RSS of this process in bytes, or None where it can not be read
+def current_rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+# Reset the peak RSS of this process so the next reading covers only what follows, where the kernel allows it (Linux)
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+# Return the peak RSS of this process in bytes, since the last reset_peak_rss where supported
+def peak_rss_bytes():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+# Return a new, empty run report, holding the performance counter it was started at for the wall time of the build
+#   abort_on_fanout: raise an error from any merge that adds rows through duplicate keys
+def new_run_report(abort_on_fanout=False):
+    return {'started': datetime.now().isoformat(timespec='seconds'), 'start_counter': time.perf_counter(), 'abort_on_fanout': abort_on_fanout, 'stages': []}
+
+
+# Instrument the stage run inside the with block, yielding the stage record for the block to add rows_out and other details
+#   The record is added to the report even when the stage raises, with the error message. Pass report=None to skip recording.
+@contextmanager
+def report_stage(report, name, rows_in=None):
+    record = {'stage': name, 'rows_in': rows_in}
+    rss_before = current_rss_bytes()
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record['error'] = str(e)
+        raise
+    finally:
+        record['seconds'] = round(time.perf_counter() - start, 4)
+        rss_after = current_rss_bytes()
+        record['rss_delta_mb'] = None if rss_before is None or rss_after is None else round((rss_after - rss_before) / 1024 ** 2, 2)
+        if report is not None:
+            report['stages'].append(record)
+
+
+# Left merge right_df onto left_df as an instrumented stage, recording the key cardinality of right_df and any fan-out
+#   right_df is expected to hold one row per key (validate='many_to_one'), rows added through duplicate keys are reported
+#   as fanout_rows and raise a ValueError when the report aborts on fan-out
+def merge_stage(report, name, left_df, right_df, on, **merge_options):
+    with report_stage(report, f'merge {name}', rows_in=len(left_df)) as record:
+        duplicated_keys = right_df.duplicated(subset=on, keep=False)
+        record['right_rows'] = len(right_df)
+        record['right_unique_keys'] = int(len(right_df) - right_df.duplicated(subset=on).sum())
+        merged_df = pd.merge(left_df, right_df, how='left', on=on, **merge_options)
+        record['rows_out'] = len(merged_df)
+        record['fanout_rows'] = len(merged_df) - len(left_df)
+        if record['fanout_rows'] and report is not None and report['abort_on_fanout']:
+            examples = right_df.loc[duplicated_keys, on].drop_duplicates().head(5).astype(str).to_dict(orient='records')
+            raise ValueError(f'Merging {name} added {record["fanout_rows"]} rows through duplicate {on} keys, e.g. {examples}')
+    return merged_df
+
+
+# Write the run report as json, with the wall time since the report was started as total_seconds
+#   Source loads run as concurrent stages, so the sum of the stage times overlaps and is kept apart as stage_seconds_sum
+def write_run_report(report, path):
+    report['finished'] = datetime.now().isoformat(timespec='seconds')
+    report['total_seconds'] = round(time.perf_counter() - report['start_counter'], 4)
+    report['stage_seconds_sum'] = round(sum(stage['seconds'] for stage in report['stages']), 4)
+    with open(path, 'w') as f:
+        json.dump({key: value for key, value in report.items() if key != 'start_counter'}, f, indent=2)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import numpy as np
+import pandas as pd
+from nda_io import read_master_data_file, read_nda_file
+from nda_schema import check_columns, read_header
+from run_report import merge_stage, report_stage
+from worker_pool import run_calls
+
+# Planner for the source registry in make_participants_tsv.py
+#   Each registry entry is a hashmap with
+#     name: short name of the projection, used in messages
+#     path: source file the projection is read from
+#     reader: 'master' for the streamed tabulated master data file, 'nda' for NDA Dictionary tab-delimited files
+#     column_map: hashmap of source column name to participants.tsv column name, including the key columns
+#     merge_on: participants.tsv key columns the projection is left merged on
+#     coalesce: optional list of columns whose existing values are overwritten by the projection's non-null values
+#     dedupe: optional hashmap reducing the projection to one row per merge_on key before it is merged (default: default_dedupe), with the keys
+#       policy: 'latest' keeps the row with the latest order_by date, 'first' keeps the first non-null value of every
+#         column in file order and 'error' raises an error on duplicate keys
+#       order_by: source column the 'latest' policy orders rows by (e.g. interview_date), read alongside the column_map
+#       order_format: optional date format of the order_by column (default: nda_date_format)
+#     bulk: optional flag of the entries of a bulk import spec (see load_bulk_spec), merged after every other entry as one block
+#   Entries sharing a path are read together in a single parse and split into their projections in memory.
+
+# Policies of the registry entries' dedupe hashmaps
+dedupe_policies = ['latest', 'first', 'error']
+
+# Dedupe hashmap of the registry entries without one, so no merge can add rows to participants_df through duplicate keys
+default_dedupe = {'policy': 'error'}
+
+# Date format of NDA Dictionary date columns such as interview_date
+nda_date_format = '%m/%d/%Y'
+
+# Number of source files parsed at once by load_sources
+default_load_workers = min(8, os.cpu_count() or 1)
+
+# Hashmap of registry reader to the delimiter of the header row of its files
+reader_delimiters = {
+    'master': ',',
+    'nda': '\t'
+}
+
+# Source columns of the participants.tsv keys in NDA Dictionary files, added to the column_map of bulk import entries
+bulk_key_columns = {'subjectkey': 'participant_id', 'eventname': 'session_id'}
+
+# Column spec of the bulk import columns without one in their spec, filling NaNs with the 888 sentinel like the other columns
+bulk_default_column_spec = {'fill': 888}
+
+
+# Return the dedupe hashmap of a registry entry, default_dedupe for entries without one
+def entry_dedupe(entry):
+    return entry.get('dedupe', default_dedupe)
+
+
+# Return the source columns a registry entry reads, its column_map columns followed by its dedupe order_by column
+def projection_columns(entry):
+    order_by = entry_dedupe(entry).get('order_by')
+    return list(entry['column_map']) + ([order_by] if order_by is not None and order_by not in entry['column_map'] else [])
+
+
+# Plan one read per source file, projecting the union of the columns of every registry entry that uses it
+def plan_source_reads(registry):
+    read_plan = {}
+    for entry in registry:
+        dedupe = entry_dedupe(entry)
+        if dedupe['policy'] not in dedupe_policies:
+            raise ValueError(f"Registry entry {entry['name']} has dedupe policy {dedupe['policy']}, expected one of {dedupe_policies}")
+        if dedupe['policy'] == 'latest' and 'order_by' not in dedupe:
+            raise ValueError(f"Registry entry {entry['name']} has dedupe policy latest without an order_by column")
+        read = read_plan.setdefault(entry['path'], {'reader': entry['reader'], 'columns': [], 'key_columns': {}})
+        if read['reader'] != entry['reader']:
+            raise ValueError(f"Registry entry {entry['name']} reads {entry['path']} with reader {entry['reader']}, other entries use {read['reader']}")
+        read['columns'] += [col for col in projection_columns(entry) if col not in read['columns']]
+        # Source column names of the merge keys, used by the master reader to drop rows as it streams
+        read['key_columns'].update({col: entry['column_map'][col] for col in entry['column_map'] if entry['column_map'][col] in entry['merge_on']})
+    return read_plan
+
+
+# Check the header row of every file of a read plan before any of them is parsed, raising one ValueError listing the columns
+#   missing from each file with their closest header columns (see nda_schema.check_columns)
+def check_read_plan(read_plan):
+    messages = []
+    for path, read in read_plan.items():
+        try:
+            check_columns(path, read_header(path, reader_delimiters[read['reader']]), read['columns'])
+        except ValueError as e:
+            messages.append(str(e))
+    if messages:
+        raise ValueError('\n'.join(messages))
+
+
+# Read one source file of the read plan, recording the read as a stage of the optional run report
+def load_source(path, read, key_df, cache_dir=None, report=None):
+    with report_stage(report, f'load {os.path.basename(path)}') as record:
+        if read['reader'] == 'master':
+            source_df = read_master_data_file(path, read['columns'], key_df, read['key_columns'])
+        else:
+            source_df = read_nda_file(path, read['columns'], cache_dir)
+        record['rows_out'] = len(source_df)
+        record['columns'] = len(source_df.columns)
+    return source_df
+
+
+# Execute the read plan, returning a hashmap of source path to the dataframe holding every planned column
+#   key_df: dataframe of the participants.tsv keys to keep from the master data file (e.g. qc_subjects)
+#   report: optional run report each read is recorded in as a stage
+#   workers: number of source files parsed at once on a thread pool, the CSV and Parquet parsers release the GIL while
+#     parsing so the reads overlap. Every read runs to completion, the failed ones are raised together afterwards (see worker_pool.py).
+def load_sources(read_plan, key_df, cache_dir=None, report=None, workers=1):
+    calls = {path: (load_source, path, read, key_df, cache_dir, report) for path, read in read_plan.items()}
+    return run_calls(calls, workers, 'load', 'source files')
+
+
+# Split a registry entry's projection out of the dataframe read for its source file, keeping the file's column order
+#   The projection keeps the entry's dedupe order_by column until dedupe_projection drops it
+def split_projection(source_df, entry):
+    columns = [col for col in source_df.columns if col in projection_columns(entry)]
+    return source_df[columns].rename(columns=entry['column_map'])
+
+
+# Reduce a registry entry's projection to one row per merge_on key with the entry's dedupe policy, as a single vectorized
+#   sort or group-by, so the left merge can not add rows to participants_df
+def dedupe_projection(projection_df, entry):
+    dedupe = entry_dedupe(entry)
+    merge_on = entry['merge_on']
+    order_by = dedupe.get('order_by')
+    if dedupe['policy'] == 'latest':
+        # Stable sort by date so the last row of each key is its latest, or its last in file order among equal dates, with unparseable dates first
+        order = pd.to_datetime(projection_df[entry['column_map'].get(order_by, order_by)], format=dedupe.get('order_format', nda_date_format), errors='coerce')
+        positions = order.reset_index(drop=True).sort_values(kind='stable', na_position='first').index
+        projection_df = projection_df.iloc[positions].drop_duplicates(subset=merge_on, keep='last')
+    if order_by is not None and order_by not in entry['column_map']:
+        projection_df = projection_df.drop(columns=order_by)
+    if dedupe['policy'] == 'first':
+        projection_df = projection_df.groupby(merge_on, sort=False, observed=True).first().reset_index()
+    elif dedupe['policy'] == 'error':
+        duplicated_keys = projection_df.duplicated(subset=merge_on, keep=False)
+        if duplicated_keys.any():
+            examples = projection_df.loc[duplicated_keys, merge_on].drop_duplicates().head(5).astype(str).to_dict(orient='records')
+            raise ValueError(f"{entry['name']} has {int(duplicated_keys.sum())} rows with duplicate {merge_on} keys, e.g. {examples}")
+    return projection_df
+
+
+# Left merge a registry entry's projection onto participants_df, overwriting the entry's coalesce columns with its non-null values
+#   report: optional run report the merge is recorded in as a stage, with its key cardinality and fan-out
+def merge_projection(participants_df, projection_df, entry, report=None):
+    coalesce_columns = entry.get('coalesce', [])
+    if not coalesce_columns:
+        return merge_stage(report, entry['name'], participants_df, projection_df, entry['merge_on'])
+
+    participants_df = merge_stage(report, entry['name'], participants_df, projection_df, entry['merge_on'], suffixes=('', '_new'))
+    # Overwrite the coalesce columns with the non-null new values (columns with '_new' suffix) in one combine over the whole block,
+    #   which casts columns whose new and existing values differ in dtype (e.g. Int16 and Int64) to their common dtype
+    new_values = participants_df[[col + '_new' for col in coalesce_columns]].set_axis(coalesce_columns, axis=1)
+    participants_df[coalesce_columns] = new_values.combine_first(participants_df[coalesce_columns])[coalesce_columns]
+    return participants_df.drop(columns=[col + '_new' for col in coalesce_columns])
+
+
+# Return the categorical dtypes the key columns of participants_df are interned into for merging
+#   Categories are sorted so codes follow the A to Z order of the keys
+def key_dtypes(participants_df, key_columns):
+    return {col: pd.CategoricalDtype(sorted(participants_df[col].dropna().unique())) for col in key_columns}
+
+
+# Convert the key columns of df to the shared categorical key dtypes, dropping rows whose keys are not categories,
+#   since those rows can never match participants_df in a left merge
+def encode_keys(df, dtypes):
+    dtypes = {col: dtype for col, dtype in dtypes.items() if col in df.columns}
+    return df.astype(dtypes).dropna(subset=list(dtypes))
+
+
+# Cast the columns of df listed in merge_dtypes to their compact dtypes where the cast is lossless, leaving other columns as read
+def compact_columns(df, merge_dtypes):
+    for col in df.columns:
+        if col in merge_dtypes:
+            try:
+                compacted = df[col].astype(merge_dtypes[col])
+            except (TypeError, ValueError):
+                continue
+            # Casts between integer dtypes wrap around instead of raising, keep the column as read unless every value round trips
+            if np.array_equal(compacted.to_numpy(dtype='float64', na_value=np.nan), df[col].to_numpy(dtype='float64', na_value=np.nan), equal_nan=True):
+                df[col] = compacted
+    return df
+
+
+# Return a registry entry's projection from source_dfs ready to merge: its keys encoded, its values compacted and its rows deduped
+def prepare_projection(source_dfs, entry, dtypes, merge_dtypes={}, report=None):
+    projection_df = encode_keys(split_projection(source_dfs[entry['path']], entry), dtypes)
+    projection_df = compact_columns(projection_df, merge_dtypes)
+    with report_stage(report, f"dedupe {entry['name']}", rows_in=len(projection_df)) as record:
+        projection_df = dedupe_projection(projection_df, entry)
+        record['rows_out'] = len(projection_df)
+    return projection_df
+
+
+# Merge the projections of the bulk import entries onto participants_df as one block of columns
+#   Each projection, deduped to one row per key, is aligned to the participants_df rows by a left merge on the keys alone,
+#   so the wide participants_df is not copied once per entry, and the aligned blocks are concatenated onto it in one go.
+#   Columns imported by several entries are resolved with one combine_first per entry over all of its overlapping columns,
+#   the non-null values of later entries taking precedence like the coalesce of registry entries.
+def merge_bulk(participants_df, entries, source_dfs, dtypes, merge_dtypes={}, report=None):
+    aligned_dfs = []
+    for entry in entries:
+        projection_df = prepare_projection(source_dfs, entry, dtypes, merge_dtypes, report)
+        aligned_df = merge_stage(report, entry['name'], participants_df[entry['merge_on']], projection_df, entry['merge_on'])
+        aligned_dfs.append(aligned_df.drop(columns=entry['merge_on']).set_axis(participants_df.index))
+
+    columns = bulk_columns(entries)
+    imported = [col for aligned_df in aligned_dfs for col in aligned_df.columns]
+    overlapping = [col for col in columns if imported.count(col) > 1]
+    overlap_df = participants_df[[]]
+    for aligned_df in aligned_dfs:
+        entry_overlap = [col for col in aligned_df.columns if col in overlapping]
+        if entry_overlap:
+            overlap_df = aligned_df[entry_overlap].combine_first(overlap_df)
+    block_df = pd.concat([aligned_df.drop(columns=overlapping, errors='ignore') for aligned_df in aligned_dfs] + [overlap_df], axis=1)
+    return pd.concat([participants_df, block_df[columns]], axis=1)
+
+
+# Merge each registry entry's projection from source_dfs onto participants_df in registry order, then the bulk import entries
+#   The participant_id and session_id keys are interned into shared categorical codes once, so every merge joins on integer
+#   codes instead of strings, and coded values are held in the compact dtypes of merge_dtypes (e.g. nullable Int16).
+#   The keys are returned as categoricals, convert them back to strings before sorting on them.
+#   report: optional run report every merge is recorded in as a stage
+def merge_sources(participants_df, registry, source_dfs, merge_dtypes={}, report=None):
+    dtypes = key_dtypes(participants_df, ['participant_id', 'session_id'])
+    participants_df = encode_keys(participants_df, dtypes)
+    for entry in registry:
+        if not entry.get('bulk'):
+            participants_df = merge_projection(participants_df, prepare_projection(source_dfs, entry, dtypes, merge_dtypes, report), entry, report)
+    bulk_entries = [entry for entry in registry if entry.get('bulk')]
+    if bulk_entries:
+        participants_df = merge_bulk(participants_df, bulk_entries, source_dfs, dtypes, merge_dtypes, report)
+    return participants_df
+
+
+# Load the registry entries of a bulk import spec, a json list of hashmaps with the keys
+#   name: short name of the instrument, used in messages
+#   path: NDA Dictionary file the columns are read from
+#   columns: source columns to import, as a list to keep their source names or a hashmap of source to participants.tsv column name
+#   merge_on: optional keys the columns are merged on (default: participant_id and session_id), participant_id alone for
+#     instruments that do not change across sessions
+#   dedupe: optional dedupe hashmap as in registry entries (default: {"policy": "error"}), bulk columns are merged one row per key
+#   column_specs: optional hashmap of participants.tsv column to its spec (see column_encoding.py, default: bulk_default_column_spec)
+#   Columns imported by several entries are coalesced in spec order, the non-null values of later entries overwriting the
+#   earlier ones, so list a longitudinal instrument before the baseline instrument that takes precedence over it.
+#   reserved_columns: participants.tsv columns built by the registry, which bulk columns can not overwrite
+def load_bulk_spec(path, reserved_columns):
+    with open(path) as f:
+        spec = json.load(f)
+    entries = []
+    for spec_entry in spec:
+        missing_keys = [key for key in ('name', 'path', 'columns') if key not in spec_entry]
+        if missing_keys:
+            raise ValueError(f'Bulk import entry {spec_entry.get("name", len(entries))} in {path} is missing {missing_keys}')
+        merge_on = spec_entry.get('merge_on', ['participant_id', 'session_id'])
+        if 'participant_id' not in merge_on or any(col not in bulk_key_columns.values() for col in merge_on):
+            raise ValueError(f"Bulk import entry {spec_entry['name']} merges on {merge_on}, expected participant_id and optionally session_id")
+        columns = spec_entry['columns']
+        if isinstance(columns, list):
+            columns = {col: col for col in columns}
+        reserved = [name for col, name in columns.items() if col in bulk_key_columns or name in reserved_columns or name in bulk_key_columns.values()]
+        if reserved:
+            raise ValueError(f"Bulk import entry {spec_entry['name']} imports {reserved}, which are already participants.tsv columns")
+        imported = bulk_columns(entries)
+        entries.append({
+            'name': spec_entry['name'],
+            'path': spec_entry['path'],
+            'reader': 'nda',
+            'column_map': {**{col: name for col, name in bulk_key_columns.items() if name in merge_on}, **columns},
+            'merge_on': merge_on,
+            'coalesce': [name for name in columns.values() if name in imported],
+            'dedupe': spec_entry.get('dedupe', default_dedupe),
+            'column_specs': {name: spec_entry.get('column_specs', {}).get(name, bulk_default_column_spec) for name in columns.values()},
+            'bulk': True
+        })
+    return entries
+
+
+# Return the participants.tsv columns imported by the bulk import entries of a registry, in the order they are first imported
+def bulk_columns(registry):
+    columns = {}
+    for entry in registry:
+        if entry.get('bulk'):
+            columns.update({name: None for name in entry['column_map'].values() if name not in entry['merge_on']})
+    return list(columns)
+
+
+# Return the column specs of the bulk import columns of a registry, the spec of the last entry importing a column winning
+def bulk_column_specs(registry):
+    return {name: spec for entry in registry if entry.get('bulk') for name, spec in entry['column_specs'].items()}
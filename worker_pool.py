@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Runs of independent calls on a thread pool, used to parse the source files and to write the outputs in parallel
+#   Every call runs to completion even when others fail and the failures are raised together afterwards, so a run reports
+#   every failed file instead of only the first.
+
+
+# Run the calls of a hashmap of label to (function, *args) on a pool of workers threads, returning the hashmap of label to result
+#   action and items describe the calls in the RuntimeError raised when any of them fail, e.g. 'load' and 'source files' raise
+#   'Failed to load 2 of 9 source files:' followed by the label and error of each failed call, chained to the first error
+def run_calls(calls, workers, action, items):
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {label: executor.submit(*call) for label, call in calls.items()}
+    errors = {label: future.exception() for label, future in futures.items() if future.exception() is not None}
+    if errors:
+        messages = '\n'.join(f'  {label}: {type(e).__name__}: {e}' for label, e in errors.items())
+        raise RuntimeError(f'Failed to {action} {len(errors)} of {len(calls)} {items}:\n{messages}') from next(iter(errors.values()))
+    return {label: future.result() for label, future in futures.items()}